@@ -0,0 +1,250 @@
+# Replays a session recorded by chanserv.py: create a file named
+# chanserv.py-record in your xchat directory, and the script writes down
+# everything it sees and sends to chanserv.py-<date>-<time>.rec there. What
+# the server said, the /cs commands typed and disconnects are fed to a fresh
+# copy of the script at full speed, on a clock that follows the recording.
+# What it sends is compared with what it sent back then, so an optimization
+# can be checked against real traffic. Nothing here talks to a network.
+#
+# python bench/replay.py session.rec      - replay, show differences and CPU time per hook
+# python bench/replay.py -v session.rec   - also show everything that was sent
+# python bench/replay.py -p session.rec   - profile the whole replay with cProfile
+
+import cProfile
+import difflib
+import os
+import pstats
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(1, os.path.dirname(here))
+import xchat
+from run import Profile, clock
+
+prefixes = '~&@%+'
+
+def read(path):
+    """The events of a recording, as (seconds, connection id, kind, text)"""
+    events = []
+    for line in open(path):
+        if line.startswith('#') or not line.strip():
+            continue
+        fields = line.rstrip('\n').split(' ', 3)
+        events.append((int(fields[0]) / 1000.0, int(fields[1]), fields[2], (fields[3:] or [''])[0]))
+    return events
+
+class Replay(object):
+    """A recording, played back into a fresh copy of chanserv.py
+
+    The copy records the replay as well, so that what it sends is written
+    down the same way as what was sent back then. The clock only moves when
+    the recording says so. Times are whole milliseconds, so an answer can
+    seem to come before the question went out. Every event therefore waits
+    until the copy has sent as much as had been sent before it, running its
+    timers for up to patience seconds more."""
+    patience = 10
+
+    def __init__(self, events):
+        xchat.reset()
+        xchat.clock.freeze()
+        self.events = events
+        self.base = xchat.clock.time()
+        self.connections = {}
+        self.expected = {}
+        self.expected_count = 0
+        self.profiles = {}
+        self.timers = Profile('timers', xchat.fire_timer)
+        # The connections there were when recording started are there when the script loads
+        for seconds, id, kind, text in events:
+            if kind != '=':
+                break
+            self.connect(id, text)
+        if not self.connections:
+            # The script needs a context to load in
+            xchat.current = xchat.Connection(id=None).context()
+            xchat.connections.remove(xchat.current.connection)
+        open(os.path.join(xchat.xchatdir, 'chanserv.py-record'), 'w').close()
+        sys.modules.pop('chanserv', None)
+        import chanserv
+        chanserv.time = xchat.clock
+        self.sent = {}
+        self.recorder = chanserv.recorder
+        self.recorder.fd.flush()
+        for seconds, id, kind, text in read(self.recorder.path):
+            if kind == '>':
+                self.sent.setdefault(id, []).append(text)
+        write = self.recorder.write
+        def record(id, kind, text):
+            if kind == '>':
+                self.sent.setdefault(id, []).append(text)
+            write(id, kind, text)
+        self.recorder.write = record
+        self.collect()
+        for hook in xchat.hooks:
+            if hook.kind in ('server', 'command', 'print'):
+                label = '%s hook' % hook.name
+                while label in self.profiles:
+                    label += "'"
+                self.profiles[label] = hook.callback = Profile(label, hook.callback)
+
+    def connect(self, id, text):
+        network, server, nick = (text.split(' ') + ['', ''])[:3]
+        connection = self.connections[id] = xchat.Connection(server=server, network=network, nick=nick, id=id)
+        connection.channels = {}
+        connection.users = lambda channel: list(connection.channels.get(channel.lower(), {}).values())
+        xchat.current = connection.context()
+
+    def receive(self, connection, line):
+        """Hand a line to the script, in the context xchat would use"""
+        word = line.split(' ')
+        if len(word) < 2:
+            return
+        ours = word[0].lstrip(':').split('!')[0].lower() == connection.nick.lower()
+        if ours and word[1] == 'JOIN':
+            connection.context(word[2].lstrip(':'))
+        if ours and word[1] == 'NICK':
+            connection.nick = word[2].lstrip(':')
+        context = connection.context()
+        for arg in word[2:5]:
+            if arg.lstrip(':').lower() in connection.contexts:
+                context = connection.context(arg.lstrip(':'))
+                break
+        xchat.current = context
+        xchat.dispatch('server', word[1].upper(), line)
+        self.follow(connection, word)
+
+    def follow(self, connection, word):
+        """Keep the members of channels up to date, for get_list('users'),
+        like xchat does after the script has seen a line"""
+        channels = connection.channels
+        nick, host = (word[0].lstrip(':').split('!', 1) + [''])[:2]
+        command = word[1].upper()
+        if command == '353':
+            members = channels.setdefault(word[4].lower(), {})
+            for entry in ' '.join(word[5:]).lstrip(':').split():
+                name = entry.lstrip(prefixes)
+                who, userhost = (name.split('!', 1) + [None])[:2]
+                members[who.lower()] = xchat.User(who, userhost, entry[:len(entry) - len(name)])
+        elif command == '352' and word[7].lower() in channels.get(word[3].lower(), {}):
+            channels[word[3].lower()][word[7].lower()].host = '%s@%s' % (word[4], word[5])
+        elif command == 'JOIN':
+            if nick.lower() == connection.nick.lower():
+                channels[word[2].lstrip(':').lower()] = {}
+            channels.setdefault(word[2].lstrip(':').lower(), {})[nick.lower()] = xchat.User(nick, host)
+        elif command in ('PART', 'KICK'):
+            gone = command == 'KICK' and word[3] or nick
+            if gone.lower() == connection.nick.lower():
+                channels.pop(word[2].lower(), None)
+            else:
+                channels.get(word[2].lower(), {}).pop(gone.lower(), None)
+        elif command in ('QUIT', 'NICK'):
+            for members in channels.values():
+                member = members.pop(nick.lower(), None)
+                if member and command == 'NICK':
+                    member.nick = word[2].lstrip(':')
+                    members[member.nick.lower()] = member
+        elif command == 'MODE' and word[2].lower() in channels:
+            members, sign, args = channels[word[2].lower()], '+', word[4:]
+            for mode in word[3].lstrip(':'):
+                if mode in '+-':
+                    sign = mode
+                elif mode in 'ov' and args:
+                    member = members.get(args.pop(0).lstrip(':').lower())
+                    if member:
+                        char = mode == 'o' and '@' or '+'
+                        prefix = member.prefix.replace(char, '') + (sign == '+' and char or '')
+                        member.prefix = ''.join([c for c in prefixes if c in prefix])
+                elif mode in 'beIqk' or (mode in 'flj' and sign == '+'):
+                    args[:1] = []
+
+    def collect(self):
+        # What was sent is in the copy's recording, xchat doesn't need to see it
+        for connection in self.connections.values():
+            connection.outbox = []
+
+    def sent_count(self):
+        return sum([len(commands) for commands in self.sent.values()])
+
+    def advance(self, until, sent=0):
+        """Run the timers due until some time, and later ones until the copy
+        has sent as much as it should have, and move the clock on"""
+        while True:
+            timer = xchat.next_timer()
+            if timer is None or timer.due > until and (self.sent_count() >= sent or timer.due > until + self.patience):
+                break
+            self.timers(timer)
+            self.collect()
+        xchat.clock.skip_to(until)
+
+    def play(self):
+        for seconds, id, kind, text in self.events:
+            if kind == '>':
+                self.expected.setdefault(id, []).append(text)
+                self.expected_count += 1
+                continue
+            self.advance(self.base + seconds + 0.001, self.expected_count)
+            if kind == '=':
+                if id not in self.connections:
+                    self.connect(id, text)
+                continue
+            connection = self.connections[id]
+            if kind == '<':
+                self.receive(connection, text)
+            elif kind == '/':
+                channel, command = (text + ' ').split(' ', 1)
+                xchat.current = connection.context(channel != connection.server and channel or None)
+                xchat.dispatch('command', 'CS', ('cs ' + command).rstrip(' '))
+            elif kind == '!':
+                xchat.current = connection.context()
+                xchat.dispatch('print', text, text)
+            self.collect()
+        # Give whatever is still going on a minute to finish
+        if self.events:
+            self.advance(self.base + self.events[-1][0] + 60)
+
+    def differences(self):
+        """A unified diff of what was sent then and what was sent now, for
+        every connection where they differ"""
+        diffs = []
+        for id in sorted(set(self.expected) | set(self.sent), key=str):
+            diff = list(difflib.unified_diff(self.expected.get(id, []), self.sent.get(id, []),
+                                             'connection %s, recorded' % id, 'connection %s, replayed' % id, lineterm=''))
+            diffs += diff
+        return diffs
+
+def main(args):
+    verbose, profile = '-v' in args, '-p' in args
+    paths = [arg for arg in args if not arg.startswith('-')]
+    if len(paths) != 1:
+        print('Usage: python bench/replay.py [-v] [-p] recording')
+        return 2
+    events = read(paths[0])
+    replay = Replay(events)
+    start = clock()
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(replay.play)
+    else:
+        replay.play()
+    spent = clock() - start
+    recorded = sum([len(commands) for commands in replay.expected.values()])
+    sent = sum([len(commands) for commands in replay.sent.values()])
+    print('%d events on %d connections, %.1f s of session replayed in %.2f s' %
+          (len(events), len(replay.connections), events and events[-1][0] or 0, spent))
+    hot = sorted(list(replay.profiles.values()) + [replay.timers], key=lambda p: -p.spent)
+    print('cpu ms: %s' % ', '.join(['%s %.1f' % (p.name, p.spent * 1000) for p in hot if p.calls]))
+    if verbose:
+        for id, commands in sorted(replay.sent.items(), key=lambda item: str(item[0])):
+            for command in commands:
+                print('    %s > %s' % (id, command))
+    diffs = replay.differences()
+    print('%d commands recorded, %d sent: %s' % (recorded, sent, diffs and 'different' or 'the same'))
+    for line in diffs:
+        print(line)
+    if profile:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    return diffs and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
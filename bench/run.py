@@ -0,0 +1,541 @@
+# Runs /cs commands against the fake server in server.py and reports how many
+# lines went out, how many round trips to the server that took, the longest
+# xchat would have been frozen by any one callback and where the script spent
+# its CPU time. Nothing here talks to a network.
+#
+# python bench/run.py            - all scenarios, ban lists of 10 to 10000
+# python bench/run.py 100 1000   - only these ban list sizes
+# python bench/run.py -v         - also show what was sent
+# python bench/run.py parse      - time parsing the command lines in commands.txt
+# python bench/run.py match      - time compiled bans against plain regexes
+
+import os
+import random
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(1, os.path.dirname(here))
+import xchat
+from server import FakeServer, key
+
+clock = getattr(time, 'process_time', None) or time.clock
+
+class Profile(object):
+    """CPU time spent in a function, including whatever it calls"""
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+        self.calls = 0
+        self.spent = 0.0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        start = clock()
+        try:
+            return self.function(*args, **kwargs)
+        finally:
+            self.spent += clock() - start
+
+def load(server, unthrottled=True):
+    """Load a fresh copy of chanserv.py, hooked up to a fake server"""
+    sys.modules.pop('chanserv', None)
+    import chanserv
+    chanserv.time = xchat.clock
+    if unthrottled:
+        for network in chanserv.flood_limits:
+            chanserv.flood_limits[network] = (10 ** 6, 10 ** 6)
+    profiles = {}
+    def profile(owner, name, label=None):
+        profiles[label or name] = wrapper = Profile(label or name, getattr(owner, name))
+        # A plain function, so that methods still get bound
+        setattr(owner, name, lambda *args, **kwargs: wrapper(*args, **kwargs))
+    profile(chanserv, 'run_pending')
+    profile(chanserv.BanList, 'matches', 'BanList.matches')
+    profile(chanserv.Action, 'match', 'Action.match')
+    for hook in xchat.hooks:
+        if hook.kind == 'server' and hook.name in ('NOTICE', '367', '728', '354', 'PRIVMSG'):
+            label = '%s hook' % hook.name
+            profiles[label] = hook.callback = Profile(label, hook.callback)
+    server.connect()
+    for channel in server.channels.values():
+        server.join(channel.name)
+    return chanserv, profiles
+
+def random_mask(rng):
+    kind = rng.random()
+    word = lambda: ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for i in range(rng.randint(3, 9)))
+    if kind < 0.5:
+        return '*!*@%s.example.com' % word()
+    if kind < 0.7:
+        return '%s!*@*' % word()
+    if kind < 0.8:
+        return '*!*%s@*' % word()
+    if kind < 0.9:
+        return '$a:%s' % word()
+    return '*!*@*%s*' % word()
+
+def setup(size, members=5, seed=42, crowd=0):
+    xchat.reset()
+    server = FakeServer()
+    channel = server.add_channel('#bench')
+    rng = random.Random(seed)
+    for i in range(members):
+        user = server.add_user('victim%d' % i, '~v%d' % i, 'host%d.example.net' % i, i % 2 and 'acct%d' % i or None)
+        channel.members[key(user.nick)] = ''
+    for i in range(crowd):
+        user = server.add_user('user%d' % i, '~u%d' % i, 'crowd%d.example.com' % i)
+        channel.members[key(user.nick)] = i % 10 and '' or '+'
+    channel.bans = [(random_mask(rng), 'op!op@example.org', 1400000000) for i in range(size)]
+    channel.bans.insert(size // 2, ('*!*@host0.example.net', 'op!op@example.org', 1400000000))
+    channel.akicks = [(random_mask(rng).replace('$a:', ''), 'spam', 'op', i % 3 and None or xchat.clock.time() + 3600 * i)
+                      for i in range(size // 10)]
+    return server
+
+def unban(server, profiles):
+    server.cs('#bench', 'unban victim0')
+    server.run()
+
+def kickban(server, profiles):
+    server.cs('#bench', 'kb victim1 go away')
+    server.run()
+
+def mass_kickban(server, profiles):
+    server.cs('#bench', 'kb victim1,victim2,victim3,victim4 :go away')
+    server.run()
+
+def percent_unban(server, profiles):
+    """Unban someone whose ban and quiet have a % in them"""
+    channel = server.channels[key('#bench')]
+    user = server.add_user('percent', '~p', 'p.example.com', name='100% legit')
+    channel.members[key(user.nick)] = ''
+    channel.bans.append(('$r:100%*', 'op!op@example.org', 1400000000))
+    channel.quiets.append(('$r:*%?legit', 'op!op@example.org', 1400000000))
+    server.cs('#bench', 'unban percent')
+    server.run()
+    if '-bq $r:100%* $r:*%?legit' not in ' '.join(server.sent):
+        raise AssertionError("Ban with a %% in it not lifted: %r" % server.sent)
+
+def warm_ban(server, profiles):
+    server.cs('#bench', 'unban victim0')
+    server.run()
+    server.sent, server.round_trips = [], 0
+    for profile in profiles.values():
+        profile.calls, profile.spent = 0, 0.0
+    server.cs('#bench', 'ban victim2')
+    server.run()
+
+def busy_channel(server, profiles):
+    server.cs('#bench', 'kick user100 victim1 :bye')
+    server.run()
+    server.cs('#bench', 'invite user200')
+    server.run()
+
+def kick_burst(server, profiles):
+    for i in range(1, 5):
+        server.cs('#bench', 'kick victim%d :flooding' % i)
+        server.run(limit=2)
+    server.run()
+
+def missing_target(server, profiles):
+    """A ban on two nicks, one of which isn't there: the other is banned
+    all the same"""
+    server.cs('#bench', 'ban victim1,nosuchnick')
+    server.run()
+    if 'mode #bench +b *!*@host1.example.net' not in server.sent:
+        raise AssertionError("Ban lost with a missing target: %r" % server.sent)
+    # Words that aren't targets are refused, not looked up
+    server.cs('#bench', 'ban victim2 because of spam')
+    server.cs('#bench', 'kick victim3 victim4 told you to stop :)')
+    server.run()
+    if [command for command in server.sent if 'because' in command or command.startswith('remove #bench victim4')] or \
+       'remove #bench victim3 :victim4 told you to stop :)' not in server.sent:
+        raise AssertionError("Reason words taken for targets: %r" % server.sent)
+
+def nick_reused(server, profiles):
+    """Bans on nicks that changed hands: someone quit and another took the
+    nick, and someone outside the channel the script only knows by whois"""
+    server.cs('#bench', 'ban victim1')
+    server.add_user('outsider', '~out', 'old.example.com')
+    server.cs('#bench', 'ban outsider')
+    server.run()
+    server.receive('%s QUIT :bye' % server.users['victim1'].prefix())
+    del server.channels[key('#bench')].members['victim1']
+    server.add_user('victim1', '~other', 'other.example.com')
+    server.add_user('outsider', '~out', 'new.example.com')
+    xchat.clock.skip_to(xchat.clock.time() + 60)
+    server.cs('#bench', 'ban victim1')
+    server.cs('#bench', 'ban outsider')
+    server.run()
+    if 'mode #bench +b *!*@other.example.com' not in ' '.join(server.sent) or \
+       'mode #bench +b *!*@new.example.com' not in ' '.join(server.sent):
+        raise AssertionError("Banned whoever had the nick before: %r" % server.sent)
+
+def late_op(server, profiles):
+    """A ban on a nick that isn't there, with chanserv only opping us two
+    seconds later, after the action gave up: we still deop"""
+    lagged = []
+    server.do_cs_op = lambda args: lagged.append(args) or []
+    server.cs('#bench', 'ban nosuchnick')
+    server.run(limit=2)
+    del server.do_cs_op
+    for args in lagged:
+        for line in server.do_cs_op(args):
+            server.receive(line)
+    server.run()
+    if not lagged or server.sent[-1] != 'chanserv deop #bench':
+        raise AssertionError("Stayed opped after a late op: %r" % server.sent)
+
+def mask_kickban(server, profiles):
+    """A kickban on a mask that matches us and a voiced member too: neither
+    is kicked unless named"""
+    server.channels[key('#bench')].members[key('victim2')] = '+'
+    server.cs('#bench', 'kb *!*@*example.* :go away')
+    server.run()
+    kicked = [command.split()[2] for command in server.sent if command.startswith('remove')]
+    printed = [event[-1] for event in xchat.printed]
+    if sorted(kicked) != ['victim0', 'victim1', 'victim3', 'victim4'] or 'mode #bench +b *!*@*example.*' not in server.sent or \
+       not [text for text in printed if text.startswith('*!*@*example.* matches me, victim2 too')]:
+        raise AssertionError("Wrong members kicked by a mask: %r %r" % (server.sent, printed))
+    server.cs('#bench', 'kick *!*@*example.*,victim2 :you too')
+    server.run()
+    if 'remove #bench victim2 :you too' not in server.sent:
+        raise AssertionError("Voiced member not kicked when named: %r" % server.sent)
+
+def recorded_akicks(server, profiles):
+    """Feed chanserv's answers to three akick list requests, as recorded in
+    akick-list.log, and check what the script made of them"""
+    net = sys.modules['chanserv'].connection(server.connection.id)
+    for channel in ('#bench', '#other', '#secret'):
+        net.collecting_bans.add(key(channel))
+        net.akick_lists.requested.append(key(channel))
+    for line in open(os.path.join(here, 'akick-list.log')):
+        server.receive(line.rstrip('\n'))
+    found = dict([(channel, sorted([(a.ban, a.reason, a.setter, a.expires and int(a.expires - xchat.clock.time() + 30) // 60)
+                                    for a in net.akicks[channel].akicks.values()]))
+                  for channel in ('#bench', '#other', '#secret')])
+    expected = {
+        '#bench': [('$a:evilbob', 'ban evasion | private note', 'op', None),
+                   ('*!*@203.0.113.7', 'spambot', 'op', None),
+                   ('*!~troll@gateway/web/*', 'trolling', 'someop', 120),
+                   ('flood*!*@*', '', 'me', 10)],
+        '#other': [],
+        '#secret': [],
+    }
+    if found != expected or net.collecting_bans or [p for p in xchat.printed if 'AKICK' in str(p)]:
+        raise AssertionError("Akick lists parsed wrongly: %r" % found)
+
+def two_networks(server, profiles):
+    """Unban on a second network with a #bench of its own, where victim0 is
+    someone else and nothing is banned. Nothing of the first network's
+    #bench may leak into it, and it must be forgotten on disconnect."""
+    chanserv = sys.modules['chanserv']
+    other = FakeServer(name='irc.other.net', network='OtherNet', id=2)
+    channel = other.add_channel('#Bench')
+    channel.members[key(other.add_user('victim0', '~v0', 'host0.example.net').nick)] = ''
+    other.connect()
+    other.join('#Bench')
+    other.cs('#Bench', 'unban victim0')
+    other.run()
+    server.cs('#bench', 'unban victim0')
+    server.run()
+    if [command for command in other.sent if '-b' in command] or \
+       'mode #bench -b *!*@host0.example.net' not in server.sent:
+        raise AssertionError("Ban lists leaked between networks: %r" % other.sent)
+    xchat.current = other.connection.context()
+    xchat.dispatch('print', 'Disconnected', 'Disconnected (Remote host closed socket)')
+    if 2 in chanserv.connections or 1 not in chanserv.connections:
+        raise AssertionError("Wrong connection forgotten on disconnect")
+    server.sent += other.sent
+    server.round_trips += other.round_trips
+
+def flood(server, profiles):
+    """Clones, a join flood and someone repeating himself, among a few
+    thousand ordinary lines. Twelve people coming back from a netsplit and
+    four others saying the same once are no flood."""
+    server.cs('#bench', 'flood on')
+    channel = server.channels[key('#bench')]
+    def arrive(nick, host):
+        user = server.add_user(nick, '~' + nick, host)
+        channel.members[key(nick)] = ''
+        server.receive('%s JOIN %s' % (user.prefix(), channel.name))
+    for i in range(12):
+        server.receive(':split%d!~split%d@split%d.example.com QUIT :*.net *.split' % (i, i, i))
+    for i in range(12):
+        arrive('split%d' % i, 'split%d.example.com' % i)
+    for i in (0, 2, 3, 4):
+        server.receive('%s PRIVMSG #bench :lol' % server.users['victim%d' % i].prefix())
+    for i in range(3):
+        arrive('clone%d' % i, 'clones.example.com')
+    for i in range(9):
+        arrive('joiner%d' % i, 'joiner%d.example.com' % i)
+    for i in range(5000):
+        server.receive('%s PRIVMSG #bench :line %d' % (server.users['victim%d' % (i % 5)].prefix(), i))
+        if i % 50 == 49 and i < 250:
+            server.receive('%s PRIVMSG #bench :BUY cheap stuff' % server.users['victim1'].prefix())
+    server.run()
+    expected = ['remove #bench clone%d :Clone flood' % i for i in range(3)] + \
+               ['chanserv akick #bench ADD *!*@clones.example.com !T 10', 'mode #bench +q *!*@host1.example.net']
+    muted = ' '.join([command for command in server.sent if command.startswith('mode #bench +q')])
+    if [command for command in expected if command not in server.sent] or \
+       [i for i in range(9) if 'joiner%d.' % i not in muted] or 'split' in muted or \
+       [i for i in (0, 2, 3, 4) if 'host%d.' % i in muted]:
+        raise AssertionError("Floods not stopped, or the wrong ones: %r" % server.sent)
+
+def audit(server, profiles):
+    """Audit and clean a ban list with a covered ban, a quiet that is also a
+    ban and a ban from long ago among the random ones"""
+    channel = server.channels[key('#bench')]
+    now = int(xchat.clock.time())
+    channel.bans = [(mask, setter, now - 3600) for mask, setter, stamp in channel.bans]
+    channel.bans += [('*!*@*.covered.example.org', 'op!op@example.org', now - 7200),
+                     ('*!*@one.covered.example.org', 'op!op@example.org', now - 60),
+                     ('*!*@ancient.example.org', 'op!op@example.org', now - 365 * 86400)]
+    channel.quiets = [('*!*@host0.example.net', 'op!op@example.org', now - 60)]
+    server.cs('#bench', 'audit clean')
+    server.run()
+    printed = ' '.join([str(event) for event in xchat.printed])
+    removed = ' '.join([command for command in server.sent if command.startswith('mode #bench -')])
+    if '*!*@one.covered.example.org' not in removed or '*!*@host0.example.net' not in removed or \
+       'ancient' in removed or '*.covered' in removed or \
+       'ancient.example.org (ban) set by op!op@example.org 365 days ago' not in printed:
+        raise AssertionError("Audit missed something: %r" % server.sent)
+
+def hits(server, profiles):
+    """Whom a broad mask, the channel's own bans and a previewed kickban hit,
+    without anything being set or kicked. Someone who joins after the first
+    /cs hits is counted and can be kicked"""
+    server.cs('#bench', 'prefetch')
+    server.run()
+    server.cs('#bench', 'hits *!*@crowd1*.example.com')
+    user = server.add_user('latecomer', '~late', 'late.example.com')
+    server.channels[key('#bench')].members[key('latecomer')] = ''
+    server.receive('%s JOIN #bench' % user.prefix())
+    server.cs('#bench', 'hits')
+    server.run()
+    server.cs('#bench', 'p kb victim1 bye')
+    server.run()
+    printed = [event[-1] for event in xchat.printed]
+    expected = ['*!*@crowd1*.example.com hits 611 of 1506 members', '*!*@host0.example.net hits 1 of 1507 members',
+                'Would send: remove #bench victim1 :bye', 'Would send: mode #bench +b *!*@host1.example.net',
+                '*!*@host1.example.net hits 1 of 1507 members']
+    if [line for line in expected if not [text for text in printed if text.startswith(line)]] or \
+       [command for command in server.sent if command.split()[0] in ('remove', 'chanserv') or ' +b ' in command or ' +q ' in command]:
+        raise AssertionError("Wrong hits or something was sent: %r %r" % (printed, server.sent))
+    server.cs('#bench', 'kick latecomer bye')
+    server.run()
+    if 'remove #bench latecomer :bye' not in server.sent:
+        raise AssertionError("Someone who joined after /cs hits can't be kicked: %r" % server.sent)
+
+def cancel(server, profiles):
+    """Clean up a ban list one mask per step, with progress reports, and
+    cancel it halfway"""
+    chanserv = sys.modules['chanserv']
+    chanserv.chunk_above, chanserv.job_step, chanserv.job_report = 0, 0, 0.1
+    server.cs('#bench', 'audit clean')
+    server.run(limit=0.5)
+    server.cs('#bench', 'cancel')
+    server.run()
+    printed = ' '.join([event[-1] for event in xchat.printed])
+    if '% done, /cs cancel stops it' not in printed or 'Audit of #bench cancelled' not in printed or \
+       [command for command in server.sent if command.startswith('mode #bench -')] or \
+       'chanserv deop #bench' not in server.sent or chanserv.connection(1).jobs:
+        raise AssertionError("Audit not cancelled: %r %r" % (printed, server.sent))
+
+def changing_lists(server, profiles):
+    """Unban, audit and hits going through the lists in steps, while a ban
+    they already looked at is lifted, another is set and someone joins.
+    Each of them must finish all the same."""
+    chanserv = sys.modules['chanserv']
+    chanserv.chunk_above, chanserv.job_step = 0, 0.001
+    for i, command in enumerate(('unban victim0', 'audit', 'hits')):
+        server.cs('#bench', command)
+        server.run(limit=0.2)
+        user = server.add_user('late%d' % i, '~late', 'late%d.example.net' % i)
+        server.receive(':op!op@example.org MODE #bench -b *!*@host0.example.net')
+        server.receive(':op!op@example.org MODE #bench +b *!*@host4.example.net')
+        server.receive('%s JOIN #bench' % user.prefix())
+        server.run()
+    printed = ' '.join([str(event) for event in xchat.printed])
+    if chanserv.connection(1).jobs or 'Audit of #bench' not in printed or 'Members of #bench hit' not in printed or \
+       server.sent[-1] != 'chanserv deop #bench':
+        raise AssertionError("Tripped over a changing list: %r %r" % (printed, server.sent))
+
+def record_replay(outer, profiles):
+    """Record a session from the start: connecting, an unban, a kickban and
+    a timed mute. Replayed into a fresh copy of the script, it must send the
+    same, on a throttled queue like a real session."""
+    import replay
+    server = setup(len(outer.channels[key('#bench')].bans) - 1)
+    open(os.path.join(xchat.xchatdir, 'chanserv.py-record'), 'w').close()
+    chanserv, profiles = load(server, unthrottled=False)
+    server.cs('#bench', 'unban victim0')
+    server.run()
+    server.cs('#bench', 'kb victim1 bye')
+    server.cs('#bench', 'mute -t120 victim2')
+    server.run(limit=300)
+    path = chanserv.recorder.path
+    outer.sent, outer.round_trips = server.sent, server.round_trips
+    session = replay.Replay(replay.read(path))
+    session.play()
+    if not session.sent.get(1) or session.differences():
+        raise AssertionError("Replay differs from the recording:\n%s" % '\n'.join(session.differences()))
+
+def idle_channels(server, profiles):
+    """A reconnect, then joins, voices, chatter and parts in a hundred
+    channels we have no access in and never use /cs in. Nothing may be sent,
+    and the hooks should hardly notice."""
+    for hook in xchat.hooks:
+        if hook.kind == 'server' and hook.name in ('JOIN', 'MODE', 'PART', '353'):
+            label = '%s hook' % hook.name
+            profiles[label] = hook.callback = Profile(label, hook.callback)
+    server.connect()
+    names = ['#idle%d' % i for i in range(100)]
+    for name in names:
+        server.add_channel(name, access=False)
+        server.join(name)
+    for i in range(5000):
+        user, channel = server.users['victim%d' % (i % 5)], names[i % 100]
+        server.receive('%s JOIN %s' % (user.prefix(), channel))
+        server.receive(':ChanServ!ChanServ@services. MODE %s +v %s' % (channel, user.nick))
+        server.receive('%s PRIVMSG %s :line %d' % (user.prefix(), channel, i))
+        server.receive('%s PART %s' % (user.prefix(), channel))
+    server.run()
+    if server.sent:
+        raise AssertionError("Sent something for channels we don't manage: %r" % server.sent)
+
+def timed_mutes(server, profiles):
+    server.cs('#bench', 'mute -t600 victim1 victim2 victim3 victim4')
+    server.run(limit=700)
+
+def refused_lift(server, profiles):
+    """A month-long mute, and a short one whose lift is refused at first:
+    it must be tried again, and stay stored until the server confirms it.
+    A third mute is lifted by someone else while we're out, and is dropped
+    after a look at the lists instead of being lifted again and again."""
+    chanserv = sys.modules['chanserv']
+    channel = server.channels[key('#bench')]
+    server.cs('#bench', 'mute -t2592000 victim1')
+    server.cs('#bench', 'mute -t60 victim2')
+    server.run(limit=40)
+    channel.access = False
+    server.run(limit=100)
+    stored = [entry[3] for entry in chanserv.expiries.due]
+    channel.access = True
+    server.run(limit=400)
+    if '*!*@host2.example.net' not in stored or 'mode #bench -q *!*@host2.example.net' not in ' '.join(server.sent) or \
+       [entry[3] for entry in chanserv.expiries.due] != ['*!*@host1.example.net']:
+        raise AssertionError("Refused lift forgotten: %r %r" % (stored, server.sent))
+    server.cs('#bench', 'mute -t20 victim3')
+    server.run(limit=10)
+    server.receive('%s PART #bench' % server.me.prefix())
+    channel.quiets = [entry for entry in channel.quiets if entry[0] != '*!*@host3.example.net']
+    server.join('#bench')
+    server.run(limit=1800)
+    if len([command for command in server.sent if '-q *!*@host3.example.net' in command]) != 1 or \
+       [entry[3] for entry in chanserv.expiries.due] != ['*!*@host1.example.net']:
+        raise AssertionError("Lift of a mask that isn't set repeated: %r" % server.sent)
+
+scenarios = [
+    ('unban', unban),
+    ('kickban', kickban),
+    ('4x kickban', mass_kickban),
+    ('unban, % in mask', percent_unban),
+    ('ban, warm cache', warm_ban),
+    ('ban, nick reused', nick_reused),
+    ('4 kicks in 8s', kick_burst),
+    ('ban, one missing', missing_target),
+    ('late op', late_op),
+    ('4x timed mute', timed_mutes),
+    ('refused lift', refused_lift),
+    ('kick, 1500 users', busy_channel),
+    ('kickban by mask', mask_kickban),
+    ('recorded akicks', recorded_akicks),
+    ('unban, 2 nets', two_networks),
+    ('idle, 100 chans', idle_channels),
+    ('floods', flood),
+    ('audit', audit),
+    ('hits, 1500 users', hits),
+    ('cancel', cancel),
+    ('changing lists', changing_lists),
+    ('record, replay', record_replay),
+]
+
+def parse(rounds=2000):
+    """Time how long the script takes to make sense of a /cs command line,
+    for every line in commands.txt, against a channel of 1500 members"""
+    server = setup(10, crowd=1500)
+    chanserv, profiles = load(server)
+    net = chanserv.connection(server.connection.id)
+    members = chanserv.channel_members(net, server.connection.context('#bench'), '#bench')
+    lines = [line.rstrip('\n') for line in open(os.path.join(here, 'commands.txt'))
+             if line.strip() and not line.startswith('#')]
+    parsed = []
+    start = clock()
+    for i in range(rounds):
+        for line in lines:
+            command, text = (line + ' ').split(' ', 1)
+            spec = chanserv.find_command(command, text)
+            if spec.handler is chanserv.cs_targets:
+                ban_types, timer, text = '', 0, text
+                if 'flags' in spec:
+                    ban_types, timer, text = chanserv.parse_flags(text)
+                parsed.append((spec.name, ban_types, timer) + chanserv.split_targets(net, spec, text, members))
+    spent = clock() - start
+    print('%d command lines, %d with targets, %.2f us per line' % (len(lines), len(parsed) // rounds, spent * 10 ** 6 / rounds / len(lines)))
+
+def match(rounds=20):
+    """Time matching each shape of ban against 1500 users, compiled the way
+    the script does it and as the regex ban2re makes of it"""
+    server = setup(10)
+    chanserv, profiles = load(server)
+    net = chanserv.connection(server.connection.id)
+    subjects = [chanserv.subject(net, 'user%d' % i, '~u%d' % i, 'crowd%d.example.com' % i,
+                                 i % 3 and 'Real Name' or None, i % 2 and 'acct%d' % i or None) for i in range(1500)]
+    masks = ['*!*@crowd12.example.com', 'user12!*@*', '*!~u12@*', '*!*@crowd1*', '*!*@*.example.com',
+             '*!*@*rowd1*', 'user1?!*@*', '$a:acct1', '$a:acct1*', '$a:*', '$r:*name*']
+    print('%-24s %6s %10s %10s' % ('ban', 'hits', 'compiled', 'regex'))
+    for mask in masks:
+        kind, text = chanserv.ban_kind(mask)
+        index = {'$a': 5, '$r': 4}.get(kind, 0)
+        matcher, regex = chanserv.MaskMatcher(mask, net.lower), chanserv.ban2re(net.lower(text))
+        start = clock()
+        for i in range(rounds):
+            compiled = [subject for subject in subjects if matcher.match(subject)]
+        middle = clock()
+        for i in range(rounds):
+            plain = [subject for subject in subjects if subject[index] and regex.match(subject[index])]
+        end = clock()
+        if compiled != plain:
+            raise AssertionError("%s matches differently when compiled: %d vs %d" % (mask, len(compiled), len(plain)))
+        per_match = 10 ** 9 / rounds / len(subjects)
+        print('%-24s %6d %8.0fns %8.0fns' % (mask, len(compiled), (middle - start) * per_match, (end - middle) * per_match))
+
+def main(args):
+    if 'parse' in args:
+        return parse()
+    if 'match' in args:
+        return match()
+    verbose = '-v' in args
+    sizes = [int(arg) for arg in args if arg.isdigit()] or [10, 100, 1000, 10000]
+    print('%-16s %6s %6s %6s %6s %8s  %s' % ('scenario', 'bans', 'lines', 'trips', 'lists', 'stall ms', 'cpu ms'))
+    for name, scenario in scenarios:
+        for size in sizes:
+            server = setup(size, crowd='users' in name and 1500 or 0)
+            chanserv, profiles = load(server)
+            server.sent, server.round_trips = [], 0
+            xchat.list_calls.clear()
+            xchat.longest_call = 0.0
+            scenario(server, profiles)
+            hot = sorted(profiles.values(), key=lambda p: -p.spent)
+            print('%-16s %6d %6d %6d %6d %8.1f  %s' % (name, size, len(server.sent), server.round_trips, xchat.list_calls.get('users', 0), xchat.longest_call * 1000,
+                  ', '.join('%s %.1f' % (p.name, p.spent * 1000) for p in hot if p.calls)))
+            if verbose:
+                for command in server.sent:
+                    print('    > %s' % command)
+                for event in xchat.printed:
+                    print('    %s' % (event,))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
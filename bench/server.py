@@ -0,0 +1,272 @@
+# A scripted IRC server with freenode's ChanServ and NickServ, that answers
+# whatever chanserv.py sends the way the real ones would. Used by run.py
+# to run /cs commands end to end without a network.
+
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(1, os.path.dirname(here))
+import xchat
+
+def key(name):
+    """Nicks and channels the way the server compares them, rfc1459 casemapping"""
+    return name.lower().replace('[', '{').replace(']', '}').replace('\\', '|').replace('~', '^')
+
+CHANSERV = ':ChanServ!ChanServ@services.'
+NICKSERV = ':NickServ!NickServ@services.'
+ISUPPORT = 'CHANTYPES=# EXCEPTS INVEX CHANMODES=eIbq,k,flj,CFLMPQScgimnprstz CHANLIMIT=#:120 ' \
+           'PREFIX=(ov)@+ MAXLIST=bqeI:100 MODES=4 NETWORK=ExampleNet STATUSMSG=@+ CALLERID=g ' \
+           'CASEMAPPING=rfc1459 WHOX'
+
+def duration(seconds):
+    """1h 59m 50s, the way atheme shows time left"""
+    seconds, parts = int(seconds), []
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60), ('s', 1)):
+        if seconds >= size or (unit == 's' and not parts):
+            parts.append('%d%s' % (seconds // size, unit))
+            seconds %= size
+    return ' '.join(parts)
+
+class User(object):
+    def __init__(self, nick, ident, host, account=None, name='Real Name'):
+        self.nick = nick; self.ident = ident; self.host = host; self.account = account; self.name = name
+
+    def prefix(self):
+        return ':%s!%s@%s' % (self.nick, self.ident, self.host)
+
+class Channel(object):
+    def __init__(self, name):
+        self.name = name
+        self.members = {}
+        self.bans = []
+        self.quiets = []
+        self.akicks = []
+        self.access = True
+
+class FakeServer(object):
+    """Answers commands from the script, counting lines and round trips"""
+    def __init__(self, nick='me', name='irc.example.net', isupport=ISUPPORT, network='ExampleNet', id=1):
+        self.name = name
+        self.isupport = isupport
+        self.users = {}
+        self.whowas = {}
+        self.channels = {}
+        self.connection = xchat.Connection(server=name, network=network, nick=nick, id=id)
+        self.connection.users = self.members
+        self.me = self.add_user(nick, '~' + nick, 'example.org', nick)
+        self.sent = []
+        self.round_trips = 0
+        xchat.current = self.connection.context()
+
+    def add_user(self, nick, ident, host, account=None, name='Real Name'):
+        self.users[key(nick)] = User(nick, ident, host, account, name)
+        return self.users[key(nick)]
+
+    def add_channel(self, name, access=True):
+        channel = self.channels[key(name)] = Channel(name)
+        channel.access = access
+        channel.members[key(self.me.nick)] = ''
+        self.connection.context(name)
+        return channel
+
+    def members(self, name):
+        channel = self.channels[key(name)]
+        return [xchat.User(self.users[nick].nick, '%s@%s' % (self.users[nick].ident, self.users[nick].host), prefix)
+                for nick, prefix in channel.members.items()]
+
+    # Talking to the script
+    def receive(self, line):
+        """Hand a line to the script, in the context xchat would use"""
+        word = line.split(' ')
+        context = self.connection.context()
+        for arg in word[2:5]:
+            if key(arg.lstrip(':')) in self.channels:
+                context = self.connection.context(arg.lstrip(':'))
+                break
+        xchat.current = context
+        xchat.dispatch('server', word[1].upper(), line)
+
+    def cs(self, channel, command):
+        """Type a /cs command in a channel"""
+        xchat.current = self.connection.context(channel)
+        xchat.dispatch('command', 'CS', 'cs ' + command)
+
+    def connect(self):
+        """Send what a server sends after registration"""
+        self.receive(':%s 005 %s %s :are supported by this server' % (self.name, self.me.nick, self.isupport))
+        self.receive(':%s 376 %s :End of /MOTD command.' % (self.name, self.me.nick))
+        return self.run()
+
+    def run(self, limit=60):
+        """Answer everything the script sends, and run its timers, until it has
+        nothing left to do or limit seconds have passed"""
+        start = xchat.clock.time()
+        while True:
+            if self.connection.outbox:
+                outbox, self.connection.outbox = self.connection.outbox, []
+                self.round_trips += 1
+                replies = []
+                for context, command in outbox:
+                    self.sent.append(command)
+                    replies += self.handle(command)
+                for line in replies:
+                    self.receive(line)
+                continue
+            timer = xchat.next_timer()
+            if timer is None or timer.due > start + limit:
+                return
+            xchat.fire_timer(timer)
+
+    # Answering commands
+    def numeric(self, number, text):
+        return ':%s %s %s %s' % (self.name, number, self.me.nick, text)
+
+    def notice(self, service, text):
+        return '%s NOTICE %s :%s' % (service, self.me.nick, text)
+
+    def handle(self, command):
+        if command.lower().startswith('quote '):
+            command = command[6:]
+        word = command.split()
+        verb = word[0].lower()
+        verb = {'chanserv': 'cs', 'nickserv': 'ns'}.get(verb, verb)
+        if verb in ('cs', 'ns'):
+            # Services take the subcommand first: "cs akick #chan list", "ns listchans"
+            verb, word = '%s_%s' % (verb, word[1].lower()), word[1:]
+        handler = getattr(self, 'do_' + verb, None)
+        return handler and handler(word[1:]) or []
+
+    def do_whois(self, args):
+        nick = args[-1]
+        user = self.users.get(key(nick))
+        if not user:
+            return [self.numeric(401, '%s :No such nick/channel' % nick),
+                    self.numeric(318, '%s :End of /WHOIS list.' % nick)]
+        lines = [self.numeric(311, '%s %s %s * :%s' % (user.nick, user.ident, user.host, user.name))]
+        if user.account:
+            lines.append(self.numeric(330, '%s %s :is logged in as' % (user.nick, user.account)))
+        return lines + [self.numeric(318, '%s :End of /WHOIS list.' % user.nick)]
+
+    def do_whowas(self, args):
+        user = self.whowas.get(key(args[0]))
+        if not user:
+            return [self.numeric(406, '%s :There was no such nickname' % args[0]),
+                    self.numeric(369, '%s :End of WHOWAS' % args[0])]
+        return [self.numeric(314, '%s %s %s * :%s' % (user.nick, user.ident, user.host, user.name)),
+                self.numeric(369, '%s :End of WHOWAS' % user.nick)]
+
+    def do_who(self, args):
+        channel = self.channels[key(args[0])]
+        token = args[1].split(',')[1]
+        lines = []
+        for nick in channel.members:
+            user = self.users[nick]
+            lines.append(self.numeric(354, '%s %s %s %s %s :%s' % (token, user.ident, user.host, user.nick, user.account or '0', user.name)))
+        return lines + [self.numeric(315, '%s :End of /WHO list.' % channel.name)]
+
+    def do_mode(self, args):
+        channel = self.channels[key(args[0])]
+        if len(args) == 2:
+            lines = []
+            if 'b' in args[1]:
+                lines += [self.numeric(367, '%s %s %s %d' % (channel.name, mask, setter, stamp)) for mask, setter, stamp in channel.bans]
+                lines.append(self.numeric(368, '%s :End of Channel Ban List' % channel.name))
+            if 'q' in args[1]:
+                lines += [self.numeric(728, '%s q %s %s %d' % (channel.name, mask, setter, stamp)) for mask, setter, stamp in channel.quiets]
+                lines.append(self.numeric(729, '%s q :End of Channel Quiet List' % channel.name))
+            return lines
+        if channel.members.get(key(self.me.nick)) != '@':
+            return [self.numeric(482, "%s :You're not a channel operator" % channel.name)]
+        params = list(args[2:])
+        sign = '+'
+        # Like ircd, lifting a mask that isn't set is left out of the reply
+        done = []
+        for mode in args[1]:
+            if mode in '+-':
+                sign = mode
+            elif mode in 'bqov':
+                param = params.pop(0)
+                if mode in 'bq':
+                    entries = mode == 'b' and channel.bans or channel.quiets
+                    masks = [entry[0] for entry in entries]
+                    if sign == '+' and param not in masks:
+                        entries.append((param, self.me.nick, int(xchat.clock.time())))
+                    elif sign == '-' and param in masks:
+                        del entries[masks.index(param)]
+                    elif sign == '-':
+                        continue
+                elif key(param) in channel.members:
+                    channel.members[key(param)] = sign == '+' and {'o': '@', 'v': '+'}[mode] or ''
+                done.append((sign + mode, param))
+        if not done:
+            return []
+        return ['%s MODE %s %s %s' % (self.me.prefix(), channel.name, ''.join([change for change, param in done]),
+                                      ' '.join([param for change, param in done]))]
+
+    def do_remove(self, args):
+        channel = self.channels[key(args[0])]
+        nick = key(args[1])
+        if nick not in channel.members:
+            return [self.numeric(441, "%s %s :They aren't on that channel" % (args[1], channel.name))]
+        del channel.members[nick]
+        reason = ' '.join(args[2:]).lstrip(':')
+        return ['%s PART %s :requested by %s (%s)' % (self.users[nick].prefix(), channel.name, self.me.nick, reason)]
+
+    def do_cs_op(self, args, mode='+o', prefix='@'):
+        channel = self.channels[key(args[0])]
+        if not channel.access:
+            return [self.notice(CHANSERV, 'You are not authorized to perform this operation.')]
+        nick = len(args) > 1 and args[1] or self.me.nick
+        channel.members[key(nick)] = prefix
+        return ['%s MODE %s %s %s' % (CHANSERV, channel.name, mode, nick)]
+
+    def do_cs_deop(self, args):
+        return self.do_cs_op(args, '-o', '')
+
+    def do_cs_akick(self, args):
+        channel = self.channels[key(args[0])]
+        if not channel.access:
+            return [self.notice(CHANSERV, 'You are not authorized to perform this operation.')]
+        action = args[1].lower()
+        if action == 'list':
+            # Same format as atheme, account akicks are shown without $a:
+            now = xchat.clock.time()
+            channel.akicks = [akick for akick in channel.akicks if not akick[3] or akick[3] > now]
+            lines = [self.notice(CHANSERV, 'AKICK list for \x02%s\x02:' % channel.name)]
+            for i, (mask, reason, setter, expires) in enumerate(channel.akicks):
+                expires = expires and 'expires: %s, ' % duration(expires - now) or ''
+                lines.append(self.notice(CHANSERV, '%d: \x02%s\x02 %s [setter: %s, %smodified: 3 days ago]' % (i + 1, mask, reason, setter, expires)))
+            lines.append(self.notice(CHANSERV, "Total of \x02%d\x02 %s in \x02%s\x02's AKICK list." %
+                                               (len(channel.akicks), len(channel.akicks) == 1 and 'entry' or 'entries', channel.name)))
+            return lines
+        if action == 'add':
+            expires = '!T' in args and xchat.clock.time() + 60 * int(args[args.index('!T') + 1]) or None
+            channel.akicks.append((args[2], '', self.me.nick, expires))
+            return [self.notice(CHANSERV, '\x02%s\x02 has been added to the AKICK list for \x02%s\x02.' % (args[2], channel.name))]
+        if action == 'del':
+            channel.akicks = [akick for akick in channel.akicks if akick[0] != args[2]]
+            return [self.notice(CHANSERV, '\x02%s\x02 has been removed from the AKICK list for \x02%s\x02.' % (args[2], channel.name))]
+        return []
+
+    def do_ns_listchans(self, args):
+        lines = [self.notice(NICKSERV, 'Access flag(s) +AFRefiorstv in %s' % channel.name)
+                 for channel in self.channels.values() if channel.access]
+        return lines + [self.notice(NICKSERV, '\x02%d\x02 channel access matches for the nickname \x02%s\x02' % (len(lines), self.me.nick))]
+
+    def do_join(self, args):
+        channel = self.channels[key(args[0])]
+        channel.members[key(self.me.nick)] = ''
+        self.connection.context(channel.name)
+        names = ['%s%s' % (prefix, self.users[nick].nick) for nick, prefix in channel.members.items()]
+        lines = ['%s JOIN %s' % (self.me.prefix(), channel.name)]
+        for i in range(0, len(names), 50):
+            lines.append(self.numeric(353, '= %s :%s' % (channel.name, ' '.join(names[i:i+50]))))
+        return lines + [self.numeric(366, '%s :End of /NAMES list.' % channel.name)]
+
+    def join(self, channel):
+        """Join a channel like autojoin would"""
+        for line in self.do_join([channel]):
+            self.receive(line)
+        self.run()
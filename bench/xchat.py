@@ -0,0 +1,237 @@
+# Stand-in for the xchat module, so chanserv.py can be loaded and driven
+# without xchat and without a network connection. Timers run on a clock
+# that the driver in server.py can move forward; install it as the time
+# module of chanserv.py to keep the script's own timestamps in step.
+
+import tempfile
+import time
+
+EAT_NONE, EAT_XCHAT, EAT_PLUGIN, EAT_ALL = 0, 1, 2, 3
+PRI_HIGHEST, PRI_HIGH, PRI_NORM, PRI_LOW, PRI_LOWEST = 127, 64, 0, -64, -128
+
+class Clock(object):
+    """Real time plus however far we skipped ahead, so ten minute bans
+    don't take ten minutes"""
+    def __init__(self):
+        self.offset = 0.0
+        self.frozen = None
+
+    def time(self):
+        if self.frozen is not None:
+            return self.frozen
+        return time.time() + self.offset
+
+    def skip_to(self, when):
+        if self.frozen is not None:
+            self.frozen = max(self.frozen, when)
+        else:
+            self.offset += max(0, when - self.time())
+
+    def freeze(self):
+        """Stop following real time, from now on only skip_to moves the clock"""
+        self.frozen = self.time()
+
+    def __getattr__(self, name):
+        # Everything else is the time module's
+        return getattr(time, name)
+
+class Hook(object):
+    def __init__(self, kind, name, callback, userdata, timeout=0):
+        self.kind = kind; self.name = name; self.callback = callback; self.userdata = userdata
+        self.timeout = timeout
+        self.due = clock.time() + timeout / 1000.0
+
+class User(object):
+    """An entry of get_list('users')"""
+    def __init__(self, nick, host, prefix=''):
+        self.nick = nick; self.host = host; self.prefix = prefix
+
+class Context(object):
+    """A tab: the server tab of a connection, or one of its channels"""
+    def __init__(self, connection, channel=None):
+        self.connection = connection
+        self.channel = channel
+
+    def get_info(self, key):
+        if key == 'channel':
+            return self.channel or self.connection.server
+        return self.connection.get_info(key)
+
+    def get_list(self, name):
+        list_calls[name] = list_calls.get(name, 0) + 1
+        if name == 'users' and self.channel:
+            return self.connection.users(self.channel)
+        return []
+
+    def command(self, command):
+        self.connection.outbox.append((self, command))
+
+    def emit_print(self, event, *args):
+        printed.append((event,) + args)
+
+    def prnt(self, text):
+        printed.append(('Print', text))
+
+    def set(self):
+        global current
+        current = self
+
+class Connection(object):
+    """One server connection. Whatever the script sends ends up in outbox;
+    users() is replaced by the fake server to show channel members."""
+    def __init__(self, server='irc.example.net', network='ExampleNet', nick='me', id=1):
+        self.server = server
+        self.network = network
+        self.nick = nick
+        self.id = id
+        self.outbox = []
+        self.contexts = {None: Context(self)}
+        connections.append(self)
+
+    def get_info(self, key):
+        return {'nick': self.nick, 'network': self.network, 'server': self.server,
+                'host': self.server, 'xchatdir': xchatdir}.get(key)
+
+    def users(self, channel):
+        return []
+
+    def context(self, channel=None):
+        key = channel and channel.lower()
+        if key not in self.contexts:
+            self.contexts[key] = Context(self, channel)
+        return self.contexts[key]
+
+clock = Clock()
+xchatdir = tempfile.mkdtemp(prefix='chanserv-bench-')
+hooks = []
+printed = []
+# The longest any one hook or timer callback took, in seconds of real time.
+# That is how long xchat would freeze.
+longest_call = 0.0
+connections = []
+list_calls = {}
+current = None
+
+def reset():
+    """Forget all hooks, connections, output and files, and go back to real time"""
+    global current, xchatdir, longest_call
+    clock.offset = 0.0
+    clock.frozen = None
+    longest_call = 0.0
+    xchatdir = tempfile.mkdtemp(prefix='chanserv-bench-')
+    del hooks[:]
+    del printed[:]
+    del connections[:]
+    list_calls.clear()
+    current = None
+
+def get_context():
+    return current
+
+def find_context(server=None, channel=None):
+    for connection in connections:
+        if server in (None, connection.server, connection.network):
+            if server is None and connection is not current.connection:
+                continue
+            if channel is None or channel.lower() in connection.contexts:
+                return connection.context(channel)
+    return None
+
+def get_info(key):
+    return current.get_info(key)
+
+def get_prefs(name):
+    if name == 'id':
+        return current.connection.id
+    return None
+
+class ChannelItem(object):
+    """An entry of get_list('channels')"""
+    def __init__(self, context):
+        self.context = context
+        self.channel = context.get_info('channel')
+        self.network = context.get_info('network')
+        self.server = context.get_info('server')
+        self.id = context.connection.id
+        self.type = context.channel and 2 or 1
+
+def get_list(name):
+    if name == 'channels':
+        return [ChannelItem(context) for connection in connections for context in connection.contexts.values()]
+    return current.get_list(name)
+
+def command(command):
+    current.command(command)
+
+def emit_print(event, *args):
+    printed.append((event,) + args)
+
+def prnt(text):
+    printed.append(('Print', text))
+
+def hook_command(name, callback, help=None, userdata=None, priority=PRI_NORM):
+    hooks.append(Hook('command', name.upper(), callback, userdata))
+    return hooks[-1]
+
+def hook_server(name, callback, userdata=None, priority=PRI_NORM):
+    hooks.append(Hook('server', name.upper(), callback, userdata))
+    return hooks[-1]
+
+def hook_print(name, callback, userdata=None, priority=PRI_NORM):
+    hooks.append(Hook('print', name, callback, userdata))
+    return hooks[-1]
+
+def hook_timer(timeout, callback, userdata=None):
+    if not -2 ** 31 <= timeout < 2 ** 31:
+        # xchat takes a C int
+        raise OverflowError('timeout %d does not fit in a C int' % timeout)
+    hooks.append(Hook('timer', None, callback, userdata, timeout))
+    return hooks[-1]
+
+def hook_unload(callback, userdata=None):
+    hooks.append(Hook('unload', None, callback, userdata))
+    return hooks[-1]
+
+def unhook(hook):
+    if hook in hooks:
+        hooks.remove(hook)
+
+def split(line):
+    """Split a line into xchat's word and word_eol lists"""
+    word = line.split(' ')
+    return word, [' '.join(word[i:]) for i in range(len(word))]
+
+def dispatch(kind, name, line):
+    """Call the hooks for an event, in order, until one eats it. Server
+    lines go to RAW LINE hooks first, like in xchat."""
+    word, word_eol = split(line)
+    if kind == 'server' and name != 'RAW LINE' and dispatch(kind, 'RAW LINE', line) == EAT_ALL:
+        return EAT_ALL
+    for hook in list(hooks):
+        if hook.kind == kind and hook.name == name and hook in hooks:
+            if kind == 'timer':
+                continue
+            if timed(hook.callback, word, word_eol, hook.userdata) == EAT_ALL:
+                return EAT_ALL
+    return EAT_NONE
+
+def timed(callback, *args):
+    """Call a callback, remembering how long the longest call took"""
+    global longest_call
+    start = time.time()
+    try:
+        return callback(*args)
+    finally:
+        longest_call = max(longest_call, time.time() - start)
+
+def next_timer():
+    timers = [hook for hook in hooks if hook.kind == 'timer']
+    return timers and min(timers, key=lambda hook: hook.due) or None
+
+def fire_timer(timer):
+    """Move the clock to a timer and run it"""
+    clock.skip_to(timer.due)
+    if timed(timer.callback, timer.userdata):
+        timer.due = clock.time() + timer.timeout / 1000.0
+    else:
+        unhook(timer)
@@ -31,7 +31,8 @@
 # d  or deop    - Let chanserv deop you/others (/cs deop, /cs deop nick)
 # dv or devoice - Let chanserv decoice you/others (/cs devoice, /cs devoice nick)
 #
-# To op yourself, perform an action, and deop:
+# To op yourself, perform an action, and deop (after 30 seconds without
+# further actions, so a series of them needs only one op and deop):
 #
 # k  or kick    - Kick a user, possibly with comment (/cs kick nick [comment])
 # b  or ban     - Ban a user (/cs ban [-nihar] nick)
@@ -45,6 +46,15 @@
 # m  or mode    - Change channel mode (/cs mode modes here)
 # i  or invite  - Invite yourself or someone else (/cs invite [nick])
 # bans          - Show bans that apply to someone without removing them (/cs bans nick)
+# queue         - Show what is waiting to be sent to the server (/cs queue)
+# prefetch      - Look up all channel members with a single /who (/cs prefetch)
+# members       - Show how fresh the looked up channel members are (/cs members)
+# stats         - Show how long things take and how often (/cs stats [reset])
+# flood         - Stop floods in a channel, or show what was stopped (/cs flood [on|off])
+# audit         - Show ban list entries that could go, or remove them (/cs audit [#chan] [clean])
+# hits          - Show whom masks hit, or whom the bans and quiets hit (/cs hits [mask ...])
+# p  or preview - Show what a kick/ban/mute/unban would do, without doing it (/cs p kb nick)
+# cancel        - Stop going through a large ban list (/cs cancel)
 #
 # * Bans, forwards and mute take an extra optional argument that specifies
 #   what should be banned: nickname, ident, host, account and/or realname.
@@ -55,10 +65,56 @@
 #   should be lifted automatically.
 #   /cs ban -t600 nick -- Ban nick for 10 minutes
 #   /cs ban -nah -t3600 -- Ban nick, account and hostname for an hour
+#   They are remembered in chanserv.py-expiry.db in your xchat directory, so
+#   they are still lifted after a restart, as soon as you're back in the channel
+#
+# * Kick, ban, mute, forward and unban take more than one target, separated
+#   by commas, or by spaces if they are channel members or masks. Other words
+#   after a ban, mute or unban target are refused. All targets share one
+#   op/deop and packed mode lines. For kicks with a reason, separate the
+#   targets from the reason with a colon
+#   /cs kb -nah nick1 nick2 :Spam -- Kickban both nicks
+#   /cs kick nick1,nick2 Spam -- Kick both nicks
+#
+# * Kicks with a mask as target kick everyone in the channel matching it, and
+#   ban the mask. With ban types, every one of them is banned separately.
+#   We are never kicked, and opped or voiced members only if named as well.
+#   /cs kb *!*@*.example.net -- Kickban everyone from example.net
 #
 # * Unban will remove all bans matching the nick or mask you give as argument
 #   (*  and ? wildcards work)
 # * It won't actually kick, but use the /remove command
+# * Create a file named chanserv.py-prefetch in your xchat directory to look
+#   up all members of every channel you join, so bans on them need no /whois
+# * Create a file named chanserv.py-stats in your xchat directory to have
+#   /cs stats written to chanserv.py-stats.json there every 5 minutes
+# * Every server connection keeps its own ban lists, users and queues, so
+#   channels of the same name on different networks don't get mixed up
+# * Nickserv is asked where you have access on the first /cs on a server
+#   instead of when connecting, and again an hour later. Channels you
+#   haven't used /cs in and don't have access in are left alone
+# * /cs flood on mutes everyone in a join flood, kickbans clones joining from
+#   one host and mutes whoever repeats a line or changes nicks too often, for
+#   10 minutes. Rejoins after a netsplit don't count. List channels in a
+#   file named chanserv.py-flood in your xchat directory, one per line and
+#   optionally after the network name (freenode #channel), to protect them
+#   from the moment you join
+# * /cs audit lists bans, quiets and akicks that a broader one of the same
+#   list covers, quiets and bans that are also a ban or akick, expired timed
+#   entries and bans older than 90 days. /cs audit clean removes all but the
+#   old ones, to free up list entries before the server's limit is reached
+# * /cs hits and /cs preview match masks against every channel member at
+#   once, with whatever is known about them. Use /cs prefetch first to have
+#   idents, accounts and realnames of all of them
+#   /cs hits *!*@*.example.net -- How many members would this ban hit
+#   /cs p kb -nah nick -- Show the kick and bans, and whom else they hit
+# * Ban lists of more than 2000 entries are gone through a bit at a time,
+#   so xchat doesn't freeze. Unban, bans and audit report their progress
+#   every few seconds then, and /cs cancel stops them
+# * Create a file named chanserv.py-record in your xchat directory to have
+#   everything the script sees and sends written to a
+#   chanserv.py-<date>-<time>.rec file there, for bench/replay.py to play
+#   back without a network
 #
 # The following additional features are implemented
 # - Autorejoin for /remove
@@ -71,184 +127,508 @@ __module_name__        = "chanserv"
 __module_version__     = "2.3.3"
 __module_description__ = "Chanserv helper"
 
+import bisect
 import collections
+import heapq
+import itertools
 import xchat
 import time
 import re
 import os
 import math
+import json
+try:
+    import sqlite3
+except ImportError:
+    # Timed bans are then only remembered until xchat quits
+    sqlite3 = None
+
+# Everything we know about a server connection lives in its Connection,
+# keyed by xchat's id for the connection
+connections = {}
+# Heap of the timeouts of unfinished actions, of all connections
+timeouts = []
+timeout_seq = itertools.count()
+timeout_timer = None
+action_timeout = 10
+op_linger = 30 # Stay opped this long after the last action, in case more follow
+# Ban lists with more entries than this are gone through in steps of
+# job_step seconds, job_pause milliseconds apart, so xchat doesn't freeze
+chunk_above = 2000
+job_step = 0.05
+job_pause = 50
+job_report = 2 # Seconds between progress reports of such a job
+# /whois cache (see UserCache), also fed from joins, who replies and
+# account/host changes. Users we share a channel with are kept current by
+# its traffic, the others only by /whois and are looked up again sooner.
+user_ttl = 300
+whois_ttl = 10
+max_users = 10000
+# Channel members from /who %tnuhar, for channels we prefetched
+member_ttl = 3600
+max_bans_age = 1800 # Akicks set by others are invisible, so refetch now and then
+access_ttl = 3600 # Ask nickserv where we have access on the first /cs, and again after this long
+# Timed bans and mutes still to be lifted (see ExpiryStore), one timer for all
+expiry_timer = None
+expiry_slack = 5 # Lift everything due within this many seconds in one go
+expiry_retry = 300 # A lift the server hasn't confirmed by then is checked and tried again
+expiry_longest = 86400 # xchat timers take an int of milliseconds, so wake up at least daily
+# Flood protection (see FloodGuard) as (how many, in how many seconds)
+flood_joins = (8, 10)    # More joins than this mutes everyone who joined
+flood_clones = (3, 60)   # This many joins from one host kickbans the host
+flood_repeats = (4, 15)  # The same line this often mutes everyone who said it
+flood_nicks = (4, 30)    # This many nick changes from one host mutes it
+flood_memory = 256       # Events remembered per channel, for each kind of flood
+flood_ban_time = 600     # Bans and mutes for floods are lifted after this long
+flood_split_rejoin = 3600 # Joins this long after a netsplit took someone away aren't a flood
 
-# Event queue
-pending = []
-# /whois cache
-users = {}
-# /mode bq 'cache'
-bans = collections.defaultdict(list)
-quiets = collections.defaultdict(list)
-akicks = collections.defaultdict(list)
-collecting_bans = []
-current_akick = None
-can_do_akick = []
-
-abbreviations = {'kick': 'k', 'ban': 'b', 'kickban': 'kb', 'forward': 'f',
-                 'kickforward': 'kf', 'mute': 'm', 'topic': 't', 'unban': 'u',
-                 'mode': 'm', 'invite': 'i', 'op': 'o', 'deop': 'd', 'lart': 'l',
-                 'voice': 'v', 'devoice': 'dv', 'bans': 'bans'}
-expansions = dict([x[::-1] for x in abbreviations.items()])
-simple_commands = ['op', 'deop', 'voice', 'devoice']
-kick_commands = ['kick', 'kickforward', 'kickban', 'lart']
-forward_commands = ['kickforward', 'forward']
-ban_commands = ['ban', 'forward', 'mute', 'lart', 'kickban', 'kickforward']
-simple_commands += [abbreviations[x] for x in simple_commands]
-kick_commands += [abbreviations[x] for x in kick_commands]
-ban_commands += [abbreviations[x] for x in ban_commands]
-forward_commands += [abbreviations[x] for x in forward_commands]
-all_commands = list(abbreviations.keys()) + list(abbreviations.values())
 ban_sentinel = '!'
 
 debug = os.path.exists(os.path.join(xchat.get_info('xchatdir'), 'chanserv.py-debug'))
+prefetch = os.path.exists(os.path.join(xchat.get_info('xchatdir'), 'chanserv.py-prefetch'))
+dump_stats = os.path.exists(os.path.join(xchat.get_info('xchatdir'), 'chanserv.py-stats'))
+record = os.path.exists(os.path.join(xchat.get_info('xchatdir'), 'chanserv.py-record'))
+stats_interval = 300
+
+class Connection(object):
+    """The state of one server connection
+
+    Connections to different networks often have channels of the same name,
+    so nothing is shared between them: each has its own event queue, caches,
+    ban lists, outbound queue and idea of what the server supports. All
+    nicks and channels in here are keyed by key(), which follows the
+    server's casemapping."""
+    def __init__(self, id):
+        self.id = id
+        # Event queue: all unfinished actions and the actions waiting for
+        # each fact (op in a channel, whois of a nick, ban lists of a channel)
+        self.pending = []
+        self.waiting = collections.defaultdict(list)
+        # Ops we asked chanserv for, per channel (see OpLease)
+        self.leases = {}
+        self.users = UserCache(self.key)
+        # Who is in each channel we're in and with what prefix (see Member),
+        # and the names replies still coming in
+        self.roster = {}
+        self.names_pending = {}
+        # Channel members from /who %tnuhar, for channels we prefetched
+        self.members_fetched = {}
+        self.whox_pending = []
+        # /mode bq 'cache', kept up to date from mode changes once fetched
+        self.bans = collections.defaultdict(lambda: BanList(self.lower))
+        self.quiets = collections.defaultdict(lambda: BanList(self.lower))
+        self.akicks = collections.defaultdict(lambda: AkickList(self.lower))
+        self.bans_fetched = {}
+        self.collecting_bans = set()
+        # Channels where we may use chanserv akick, from nickserv (see want_access)
+        self.can_do_akick = set()
+        self.access_fetched = None
+        self.access_pending = None
+        # Channels we have access in, used /cs in, watch for floods or have
+        # timed bans in. The hooks leave all other channels alone.
+        self.managed = set()
+        self.akick_lists = AkickParser(self)
+        self.queue = None
+        # Channels we watch for floods, and who left in a netsplit when
+        self.flood_guards = {}
+        self.split = {}
+        # Jobs going through large ban lists in steps
+        self.jobs = []
+        # Server capabilities, from 005
+        self.isupport = {}
+        self.list_modes = 'beIq'
+        self.param_modes = 'kov'
+        self.set_param_modes = 'flj'
+        self.prefix_modes, self.prefix_chars = 'ov', '@+'
+        # Nicks and channels seen before, with their lowercased form
+        self.lower_table = lower_tables['rfc1459']
+        self.keys = {}
+        self.ban_matchers = BanMatchers(self.lower)
+
+    def lower(self, data):
+        """Lowercase a nick, channel or mask the way the server does"""
+        return data.lower().translate(self.lower_table)
+
+    def key(self, name):
+        """The form of a nick or channel that the caches and indexes are keyed by"""
+        try:
+            return self.keys[name]
+        except KeyError:
+            if len(self.keys) >= max_keys:
+                self.keys.clear()
+            key = self.keys[name] = self.lower(name)
+            return key
+
+    def set_casemapping(self, name):
+        """Follow the server's CASEMAPPING, unknown ones are treated as rfc1459"""
+        self.lower_table = lower_tables.get(name.lower(), lower_tables['rfc1459'])
+        self.keys.clear()
+        self.ban_matchers.clear()
+
+    def close(self):
+        """Drop everything that is still going on, we're no longer connected"""
+        for job in list(self.jobs):
+            job.stop()
+        for action in list(self.pending):
+            action.cancel()
+        for lease in self.leases.values():
+            lease.end()
+        self.leases.clear()
+        self.flood_guards.clear()
+        if self.queue:
+            self.queue.clear()
+
+def connection(id=None):
+    """The Connection with an id, by default the one of the current context"""
+    if id is None:
+        id = xchat.get_prefs('id')
+    if id not in connections:
+        connections[id] = Connection(id)
+    return connections[id]
+
+class Command(object):
+    """A /cs subcommand: its names, what kind of command it is (traits like
+    kick, ban, forward or flags) and the function that handles it"""
+    def __init__(self, name, short, traits, handler, min_args):
+        self.name = name
+        self.short = short
+        self.traits = frozenset(traits.split())
+        self.handler = handler
+        self.min_args = min_args
+
+    def __contains__(self, trait):
+        return trait in self.traits
+
+def find_command(command, text):
+    """The Command for a name or abbreviation, None if there is none"""
+    # m is both mute and mode, but a mode change always starts with a sign
+    if command == 'm' and text[:1] in ('+', '-', '='):
+        return commands['mode']
+    return commands.get(command)
 
 def cs(word, word_eol, userdata):
     """Main command dispatcher"""
     if len(word) == 1:
         return xchat.EAT_ALL
     command = word[1].lower()
+    text = len(word_eol) > 2 and word_eol[2] or ''
+    if recorder:
+        recorder.event('/', '%s %s' % (xchat.get_info('channel'), word_eol[1]))
 
-    if command not in all_commands:
+    spec = find_command(command, text)
+    if not spec:
         return xchat.EAT_NONE
 
-    args = dict(enumerate(word_eol[2:]))
-    me = xchat.get_info('nick')
+    # Usage check
+    if len(text.split()) < spec.min_args:
+        xchat.emit_print("Server Error", "Not enough arguments for %s" % command)
+        return xchat.EAT_ALL
 
-    action = Action(channel = xchat.get_info('channel'),
-                    me = me,
+    action = Action(net = connection(),
+                    channel = xchat.get_info('channel'),
+                    me = xchat.get_info('nick'),
                     context = xchat.get_context())
 
-    # The simple ones: op/voice
-    if command in simple_commands:
-        action.target = args.get(0, me)
-        action.deop = (action.target != me)
-        action.needs_op = False
-        command = expansions.get(command,command)
-        action.actions.append('chanserv %s %%(channel)s %%(target_nick)s' % command)
-        return action.schedule()
+    if 'local' not in spec:
+        # Everything else sends something sooner or later
+        stats.started = time.time()
+        want_access(action.net, action.context)
+        if valid_channel(action.channel):
+            action.net.managed.add(action.key)
+    return spec.handler(spec, action, text)
+
+def cs_queue(spec, action, text):
+    queue = action.net.queue
+    if not queue:
+        xchat.emit_print('Server Text', "Nothing sent to %s yet" % xchat.get_info('network'))
+    else:
+        for line in queue.stats():
+            xchat.emit_print('Server Text', line)
+    return xchat.EAT_ALL
 
-    # Usage check
-    if len(word) < 3:
-        if command in all_commands:
-            xchat.emit_print("Server Error", "Not enough arguments for %s" % command)
+def cs_prefetch(spec, action, text):
+    if 'WHOX' not in action.net.isupport:
+        xchat.emit_print('Server Error', "This server does not support /who %tnuhar")
+        return xchat.EAT_ALL
+    fetch_members(action.net, action.context, action.channel)
+    return xchat.EAT_ALL
+
+def cs_members(spec, action, text):
+    channel, net = action.channel, action.net
+    if action.key not in net.members_fetched:
+        xchat.emit_print('Server Text', "Members of %s have not been fetched, use /cs prefetch" % channel)
+        return xchat.EAT_ALL
+    stamp, nicks = net.members_fetched[action.key]
+    cached = len([nick for nick in nicks if nick in net.users])
+    xchat.emit_print('Server Text', "Members of %s fetched %d seconds ago: %d members, %d still cached" %
+            (channel, time.time() - stamp, len(nicks), cached))
+    return xchat.EAT_ALL
+
+def cs_stats(spec, action, text):
+    if text.strip() == 'reset':
+        stats.reset()
+    for line in stats.lines():
+        xchat.emit_print('Server Text', line)
+    return xchat.EAT_ALL
+
+def cs_flood(spec, action, text):
+    """Turn flood protection for a channel on or off, or show what it did"""
+    guards = action.net.flood_guards
+    if text.strip() == 'on' and action.key not in guards:
+        guards[action.key] = FloodGuard(action.context, action.channel)
+        action.net.managed.add(action.key)
+    elif text.strip() == 'off':
+        guards.pop(action.key, None)
+    if action.key not in guards:
+        xchat.emit_print('Server Text', "Flood protection in %s is off" % action.channel)
+        return xchat.EAT_ALL
+    for line in guards[action.key].lines():
+        xchat.emit_print('Server Text', line)
+    return xchat.EAT_ALL
+
+def cs_audit(spec, action, text):
+    """Look for ban list entries that could go, and remove them if asked"""
+    words = text.split()
+    if words and valid_channel(words[0]):
+        context = xchat.find_context(server=action.context.get_info('server'), channel=words[0])
+        if not context:
+            xchat.emit_print('Server Error', "You are not in %s" % words[0])
             return xchat.EAT_ALL
-        return xchat.EAT_NONE
+        action = Action(net = action.net, channel = words.pop(0), me = action.me, context = context)
+    action.do_audit = True
+    action.audit_clean = action.needs_op = 'clean' in words
+    return action.schedule()
 
-    if command in ('t','topic'):
-        action.actions.append('chanserv TOPIC %%(channel)s %s' % args[0])
+def cs_hits(spec, action, text):
+    """Whom masks would hit in a channel, or whom its bans and quiets hit"""
+    masks = text.replace(',', ' ').split()
+    if not masks:
+        action.do_hits = True
         action.needs_op = False
         return action.schedule()
-
-    if command in ('m','mode') and args[0][0] in '+=-':
-        action.actions.append('MODE %%(channel)s %s' % args[0])
-        return action.schedule()
-
-    if command in ('i','invite'):
-        target = args[0]
-        if target.startswith('#'):
-            action.needs_op = False
-            action.actions.append('chanserv INVITE %s' % target)
-        else:
-            if target.lower() in [x.nick.lower() for x in action.context.get_list('users')]:
-                xchat.emit_print("Server Error", "%s is already in %s" % (target, action.channel))
-                return xchat.EAT_ALL
-            action.actions.append('INVITE %s %%(channel)s' % target)
-        return action.schedule()
-
-    # Kick/ban/forward/mute handling
-    if len(word) < 4 and command in forward_commands:
+    banlist = BanList(action.net.lower)
+    for mask in masks:
+        if not valid_mask(mask):
+            xchat.emit_print("Server Error", "Invalid mask: %s" % mask)
+            return xchat.EAT_ALL
+        banlist.append(mask)
+    show_hits(action.net, channel_members(action.net, action.context, action.channel), [('', banlist)])
+    return xchat.EAT_ALL
+
+def cs_preview(spec, action, text):
+    """Go through a kick, ban, mute or unban without sending anything"""
+    command, text = (text.strip() + ' ').split(' ', 1)
+    inner = find_command(command.lower(), text)
+    if not inner or inner.handler is not cs_targets:
+        xchat.emit_print("Server Error", "Only kicks, bans, mutes and unbans can be previewed")
+        return xchat.EAT_ALL
+    if len(text.split()) < inner.min_args:
         xchat.emit_print("Server Error", "Not enough arguments for %s" % command)
         return xchat.EAT_ALL
+    action.dry_run = True
+    return inner.handler(inner, action, text.strip())
+
+def cs_cancel(spec, action, text):
+    """Stop going through the ban lists of the channel"""
+    jobs = [job for job in action.net.jobs if job.action.key == action.key]
+    if not jobs:
+        xchat.emit_print('Server Text', "Nothing to cancel in %s" % action.channel)
+    for job in jobs:
+        job.cancel()
+        xchat.emit_print('Server Text', "%s cancelled, %d of %d done" % (job.action.describe(), job.done, job.total))
+    return xchat.EAT_ALL
+
+def cs_simple(spec, action, text):
+    """op/voice and friends, chanserv does these for us"""
+    action.target = text.strip() or action.me
+    action.needs_op = False
+    leases = action.net.leases
+    if action.net.key(action.target) == action.net.key(action.me) and action.key in leases:
+        # Whatever we were asked to do last wins over the lease
+        leases[action.key].deop = False
+        if spec.name == 'deop':
+            leases.pop(action.key).end()
+    action.actions.append('chanserv %s %%(channel)s %%(target_nick)s' % spec.name)
+    return action.schedule()
 
-    # Command dispatch
-    # Check for -nihra argument
-    if command in ban_commands:
-        args_start = 3
-        while args[0].startswith('-'):
-            if args[0].startswith('-t'):
-                try:
-                    action.timer = int(args[0][2:].split(None, 1)[0])
-                except ValueError:
-                    pass
-            else:
-                action.bans = args[0][1:].split(None, 1)[0]
-            args = dict(enumerate(word_eol[args_start:]))
-            args_start += 1
-    if command in ('lart','l'):
-        action.bans = 'nihra'
+def cs_topic(spec, action, text):
+    action.actions.append('chanserv TOPIC %%(channel)s %s' % text)
+    action.needs_op = False
+    return action.schedule()
 
-    # Set target
-    action.target = args[0].split(None,1)[0]
+def cs_mode(spec, action, text):
+    if text[:1] not in ('+', '-', '='):
+        xchat.emit_print("Server Error", "Invalid mode: %s" % text)
+        return xchat.EAT_ALL
+    action.actions.append('MODE %%(channel)s %s' % text)
+    return action.schedule()
 
-    if not valid_nickname(action.target) and not valid_mask(action.target):
-        xchat.emit_print("Server Error", "Invalid target: %s" % action.target)
+def cs_invite(spec, action, text):
+    target = text
+    if target.startswith('#'):
+        action.needs_op = False
+        action.actions.append('chanserv INVITE %s' % target)
+    else:
+        if action.net.key(target) in channel_members(action.net, action.context, action.channel):
+            xchat.emit_print("Server Error", "%s is already in %s" % (target, action.channel))
+            return xchat.EAT_ALL
+        action.actions.append('INVITE %s %%(channel)s' % target)
+    return action.schedule()
+
+def cs_targets(spec, action, text):
+    """Kick/ban/forward/mute/unban handling"""
+    ban_types, timer, text = '', 0, text
+    if 'flags' in spec:
+        ban_types, timer, text = parse_flags(text)
+    if 'lart' in spec:
+        ban_types = 'nihra'
+    if len(text.split()) < spec.min_args:
+        xchat.emit_print("Server Error", "Not enough arguments for %s" % spec.name)
         return xchat.EAT_ALL
 
-    if action.bans and not valid_nickname(action.target):
-        xchat.emit_print("Server Error", "Ban types and lart can only be used with nicks, not with complete masks")
+    # Set targets
+    net = action.net
+    members = channel_members(net, action.context, action.channel)
+    targets, forward_to, reason, stray = split_targets(net, spec, text, members)
+    if stray:
+        xchat.emit_print("Server Error", "%s is not in %s, separate more targets with commas" % (stray[0], action.channel))
         return xchat.EAT_ALL
 
-    if valid_mask(action.target):
-        action.bans = 'f'
+    for target in targets:
+        if not valid_nickname(target) and not valid_mask(target):
+            xchat.emit_print("Server Error", "Invalid target: %s" % target)
+            return xchat.EAT_ALL
 
-    if not action.bans:
-        action.bans = 'h'
+        if ban_types and not valid_nickname(target) and 'kick' not in spec:
+            xchat.emit_print("Server Error", "Ban types and lart can only be used with nicks, not with complete masks")
+            return xchat.EAT_ALL
 
     # Find forward channel
-    if command in forward_commands:
-        action.forward_to = '$' + args[1].split(None,1)[0] # Kludge
-        if not valid_channel(action.forward_to[1:]):
-            xchat.emit_print("Server Error", "Invalid channel: %s" % action.forward_to[1:])
+    if 'forward' in spec:
+        if not forward_to or not valid_channel(forward_to):
+            xchat.emit_print("Server Error", "Invalid channel: %s" % forward_to)
             return xchat.EAT_ALL
-
-    # Check if target is there and schedule kick
-    if command in kick_commands:
-        if action.target.lower() not in [x.nick.lower() for x in action.context.get_list('users')]:
-            xchat.emit_print("Server Error", "%s is not in %s" % (action.target, action.channel))
+        forward_to = '$' + forward_to # Kludge
+
+    # Check if targets are there. Masks kick everyone they match, except us
+    # and opped or voiced members who aren't named, and ban the mask itself
+    # unless ban types are given.
+    jobs = []
+    named = [net.key(target) for target in targets if not valid_mask(target)]
+    for target in targets:
+        if 'kick' in spec and valid_mask(target):
+            matched = match_members(net, target, members)
+            if not matched:
+                xchat.emit_print("Server Error", "Nobody in %s matches %s" % (action.channel, target))
+                return xchat.EAT_ALL
+            spared = [nick for nick in matched if net.key(nick) == net.key(action.me) or
+                      (members[net.key(nick)].prefix and net.key(nick) not in named)]
+            if spared:
+                xchat.emit_print("Server Text", "%s matches %s too, not kicking us or opped or voiced members unless named" % (target, ', '.join(spared)))
+            matched = [nick for nick in matched if nick not in spared and net.key(nick) not in named]
+            jobs += [(nick, ban_types, ban_types and 'ban' in spec) for nick in matched]
+            if not ban_types and 'ban' in spec:
+                jobs.append((target, 'f', True))
+        elif 'kick' in spec and net.key(target) not in members:
+            xchat.emit_print("Server Error", "%s is not in %s" % (target, action.channel))
             return xchat.EAT_ALL
-        action.reason = args.get(1, 'Goodbye')
-        action.actions.append('remove %(channel)s %(target_nick)s :%(reason)s')
-
-    if command in ('m','mute'):
-        action.banmode = 'q'
-
-    if command in ban_commands:
-        action.do_ban = True
-        if 'n' in action.bans: action.actions.append('mode %(channel)s +%(banmode)s %(target_nick)s!*@*%(forward_to)s')
-        if 'i' in action.bans: action.actions.append('mode %(channel)s +%(banmode)s *!%(target_ident)s@*%(forward_to)s')
-        if 'h' in action.bans: action.actions.append('mode %(channel)s +%(banmode)s *!*@%(target_host)s%(forward_to)s')
-        if 'r' in action.bans: action.actions.append('mode %(channel)s +%(banmode)s $r:%(target_name_bannable)s%(forward_to)s')
-        if 'a' in action.bans: action.actions.append('mode %(channel)s +%(banmode)s $a:%(target_account)s%(forward_to)s')
-        if 'f' in action.bans: action.actions.append('mode %(channel)s +%(banmode)s %(target)s%(forward_to)s')
-
-    if command in ('u','unban'):
-        action.do_unban = True
-
-    if command == 'bans':
-        action.do_bans = True
-        action.needs_op = False
+        else:
+            jobs.append((target, ban_types, 'ban' in spec))
+
+    channel, context, me, dry_run = action.channel, action.context, action.me, action.dry_run
+    actions = []
+    for target, ban_types, ban in jobs:
+        action = Action(net = net, channel = channel, me = me, context = context)
+        action.dry_run = dry_run
+        action.target = target
+        action.bans = ban_types or (valid_mask(target) and 'f' or 'h')
+        action.timer = timer
+        action.forward_to = forward_to
+
+        # Schedule kick
+        if 'kick' in spec and not valid_mask(target):
+            action.reason = reason or 'Goodbye'
+            action.actions.append('remove %(channel)s %(target_nick)s :%(reason)s')
+
+        if 'quiet' in spec:
+            action.banmode = 'q'
+
+        if ban:
+            action.do_ban = True
+            if 'n' in action.bans: action.actions.append('mode %(channel)s +%(banmode)s %(target_nick)s!*@*%(forward_to)s')
+            if 'i' in action.bans: action.actions.append('mode %(channel)s +%(banmode)s *!%(target_ident)s@*%(forward_to)s')
+            if 'h' in action.bans: action.actions.append('mode %(channel)s +%(banmode)s *!*@%(target_host)s%(forward_to)s')
+            if 'r' in action.bans: action.actions.append('mode %(channel)s +%(banmode)s $r:%(target_name_bannable)s%(forward_to)s')
+            if 'a' in action.bans: action.actions.append('mode %(channel)s +%(banmode)s $a:%(target_account)s%(forward_to)s')
+            if 'f' in action.bans: action.actions.append('mode %(channel)s +%(banmode)s %(target)s%(forward_to)s')
+
+        if 'unban' in spec:
+            action.do_unban = True
+
+        if 'bans' in spec:
+            action.do_bans = True
+            action.needs_op = False
+        actions.append(action)
+
+    if len(actions) == 1:
+        return actions[0].schedule()
+    return Batch(actions, members).schedule()
+
+# Every subcommand by name and abbreviation. Traits: kick, ban (sets a ban),
+# quiet (+q instead of +b), forward (takes a channel), flags (-nihra and -t),
+# lart, unban, bans, local (only shows things). min_args is the number of
+# words needed after the command, not counting flags.
+commands = {}
+def add_command(name, short, traits='', handler=cs_targets, min_args=1):
+    spec = Command(name, short, traits, handler, min_args)
+    commands.setdefault(name, spec)
+    commands.setdefault(short, spec)
+
+add_command('op',          'o',  handler=cs_simple, min_args=0)
+add_command('deop',        'd',  handler=cs_simple, min_args=0)
+add_command('voice',       'v',  handler=cs_simple, min_args=0)
+add_command('devoice',     'dv', handler=cs_simple, min_args=0)
+add_command('kick',        'k',  'kick')
+add_command('ban',         'b',  'ban flags')
+add_command('kickban',     'kb', 'kick ban flags')
+add_command('forward',     'f',  'ban forward flags', min_args=2)
+add_command('kickforward', 'kf', 'kick ban forward flags', min_args=2)
+add_command('mute',        'm',  'ban quiet flags')
+add_command('lart',        'l',  'kick ban lart flags')
+add_command('unban',       'u',  'unban')
+add_command('topic',       't',  handler=cs_topic)
+add_command('mode',        'm',  handler=cs_mode)
+add_command('invite',      'i',  handler=cs_invite)
+add_command('bans',        'bans', 'bans')
+add_command('queue',       'queue', 'local', cs_queue, 0)
+add_command('prefetch',    'prefetch', 'local', cs_prefetch, 0)
+add_command('members',     'members', 'local', cs_members, 0)
+add_command('stats',       'stats', 'local', cs_stats, 0)
+add_command('flood',       'flood', 'local', cs_flood, 0)
+add_command('audit',       'audit', handler=cs_audit, min_args=0)
+add_command('hits',        'hits', handler=cs_hits, min_args=0)
+add_command('preview',     'p',  handler=cs_preview)
+add_command('cancel',      'cancel', 'local', cs_cancel, 0)
 
-    return action.schedule()
 xchat.hook_command('cs',cs,"For help with /cs, please read the comments in the script")
 
 class Action(object):
     """A list of actions to do, and information needed for them"""
-    def __init__(self, channel, me, context):
+    def __init__(self, net, channel, me, context):
+        self.net = net
         self.channel = channel
+        self.key = net.key(channel)
         self.me = me
         self.context = context
         self.stamp = time.time()
 
         # Defaults
-        self.deop = True
         self.needs_op = True
         self.do_ban = self.do_unban = self.do_bans = False
+        self.do_audit = self.audit_clean = False
+        self.do_hits = False
+        # Show what would be done instead of doing it
+        self.dry_run = False
         self.banmode = 'b'
         self.reason = ''
         self.bans = ''
@@ -257,6 +637,13 @@ class Action(object):
         self.target = ''
         self.forward_to = ''
         self.timer = 0
+        self.finished = False
+        self.waiting_on = set()
+        self.batch = None
+        self.match_target = None
+        self.lease = None
+        # Timed bans and mutes to lift once the ban lists show they're still set
+        self.relift = None
 
     def __str__(self):
         ctx = {'channel': self.channel, 'target': self.target}
@@ -271,32 +658,52 @@ class Action(object):
             xchat.emit_print('Server Text', "Scheduling " + str(self))
         if update_stamp:
             self.stamp = time.time()
-        pending.append(self)
-        # Am I opped?
-        self.am_op = False
-        for user in self.context.get_list('users'):
-            if user.nick == self.me and user.prefix == '@':
-                self.am_op = True
-                self.deop = False
-
-        if self.needs_op and not self.am_op:
-            self.context.command("chanserv op %s" % self.channel)
-
-        # Find needed information
         if ('a' in self.bans or 'r' in self.bans) and valid_mask(self.target) and not self.target.startswith('$'):
             xchat.emit_print('Server Error', "Invalid argument %s for account/realname ban" % self.target)
+            self.cancel()
             return xchat.EAT_ALL
+        net = self.net
+        net.managed.add(self.key)
+        if self.dry_run:
+            self.needs_op = False
+        net.pending.append(self)
+        add_timeout(self)
+        # Am I opped?
+        self.am_op = '@' in channel_members(net, self.context, self.channel).get(net.key(self.me), no_member).prefix
+        if self.needs_op:
+            leases = net.leases
+            if self.key not in leases:
+                leases[self.key] = OpLease(net, self.context, self.channel, deop=not self.am_op)
+            self.lease = leases[self.key]
+            self.lease.acquire(self)
+
+        # Find needed information
         if self.do_ban or self.do_unban or self.do_bans:
             self.resolve_nick()
         else:
             self.target_nick = self.target
 
-        if self.do_unban or self.do_bans:
+        if self.needs_bans():
             self.fetch_bans()
 
-        run_pending()
+        wait(self)
         return xchat.EAT_ALL
 
+    def waits_for(self):
+        """The facts this action still needs before it can run"""
+        facts = []
+        if self.needs_op and not self.am_op:
+            facts.append(('op', self.key))
+        if not self.resolved:
+            facts.append(('whois', self.target_nick))
+        if self.needs_bans() and self.key in self.net.collecting_bans:
+            facts.append(('bans', self.key))
+        return facts
+
+    def needs_bans(self):
+        """Does this action need the ban lists of its channel"""
+        return self.do_unban or self.do_bans or self.do_audit or self.do_hits or self.relift
+
     def resolve_nick(self, request=True):
         """Try to find nickname, ident and host"""
         self.target_nick = None
@@ -318,79 +725,158 @@ class Action(object):
             self.resolved = True
             return
 
-        self.target_nick = self.target.lower()
-        if self.target_nick in users:
-            if users[self.target_nick].time < time.time() - 10:
-                del users[self.target_nick]
-                if request:
-                    self.context.command('whois %s' % self.target_nick)
-            else:
-                self.target_ident = users[self.target_nick].ident
-                self.target_host = users[self.target_nick].host
-                self.target_name = users[self.target_nick].name
+        self.target_nick = self.net.key(self.target)
+        user = self.net.users.get(self.target_nick)
+        # Matching bans needs everything, banning only what we ban on
+        if user and user.knows('ar' if self.do_unban or self.do_bans else self.bans):
+            self.target_ident = user.ident
+            self.target_host = user.host
+            self.target_name = user.name
+            if user.name is not None:
                 self.target_name_bannable = re.sub('[^a-zA-Z0-9]', '?', self.target_name)
-                self.target_account = users[self.target_nick].account
-                self.resolved = True
-                if 'gateway/' in self.target_host and self.bans == 'h' and self.do_ban:
-                    # For gateway/* users, default to ident ban
-                    self.actions.append('mode %(channel)s +%(banmode)s *!%(target_ident)s@gateway/*%(forward_to)s')
-                    self.actions.remove('mode %(channel)s +%(banmode)s *!*@%(target_host)s%(forward_to)s')
-        else:
-            if request:
-                self.context.command('whois %s' % self.target_nick)
+            self.target_account = user.account
+            self.resolved = True
+            if 'gateway/' in self.target_host and self.bans == 'h' and self.do_ban:
+                # For gateway/* users, default to ident ban
+                self.actions.append('mode %(channel)s +%(banmode)s *!%(target_ident)s@gateway/*%(forward_to)s')
+                self.actions.remove('mode %(channel)s +%(banmode)s *!*@%(target_host)s%(forward_to)s')
+        elif request and self.batch and self.target_nick in self.batch.members and 'WHOX' in self.net.isupport:
+            # Look up all members of the batch with a single /who
+            self.batch.fetch_members = True
+        elif request:
+            send(self.net, self.context, 'whois %s' % self.target_nick)
+            stats.begin(('whois', self.target_nick))
 
     def fetch_bans(self):
-        """Read bans for a channel"""
-        bans[self.channel] = []
-        quiets[self.channel] = []
-        collecting_bans.append(self.channel)
-        self.context.command("mode %s +bq" % self.channel)
+        """Read bans for a channel, unless we already know them"""
+        net = self.net
+        if self.key in net.collecting_bans or bans_age(net, self.key) < max_bans_age:
+            return
+        net.bans_fetched.pop(self.key, None)
+        net.bans[self.key] = BanList(net.lower)
+        net.quiets[self.key] = BanList(net.lower)
+        net.akicks[self.key] = AkickList(net.lower)
+        net.collecting_bans.add(self.key)
+        stats.begin(('bans', self.key))
+        send(net, self.context, "mode %s +bq" % self.channel, BULK)
 
     def run(self):
-        """Perform our actions"""
+        """Perform our actions, going through large ban lists in steps"""
         if debug:
             xchat.emit_print('Server Text', "Running " + str(self))
-        kwargs = dict(self.__dict__.items())
+        if self.needs_bans() and ban_list_size(self.net, self.key) > chunk_above:
+            Job(self, self.plan())
+            return
+        for progress in self.plan():
+            pass
+        self.perform()
+
+    def describe(self):
+        """What this action does with the ban lists, for progress reports"""
+        if self.do_audit:
+            return "Audit of %s" % self.channel
+        if self.do_hits:
+            return "Hits in %s" % self.channel
+        if self.relift:
+            return "Timed bans in %s" % self.channel
+        return "%s of %s in %s" % (self.do_bans and 'Bans' or 'Unban', self.target, self.channel)
+
+    def plan(self):
+        """Go through the ban lists for whatever this action needs from them.
+        Yields (done, total) along the way, so it can be spread out."""
+        net = self.net
+        if self.relift:
+            lift_in(net, self.context, self.channel, self.relift)
 
         if self.do_bans:
             xchat.emit_print('Server Text', "Bans matching %s!%s@%s (r:%s, a:%s)" %
                     (self.target_nick, self.target_ident, self.target_host, self.target_name, self.target_account))
 
         if self.do_unban or self.do_bans:
-
-            for b in bans[self.channel]:
-                if self.match(b):
-                    if self.do_bans:
-                        xchat.emit_print('Server Text', b)
-                    else:
-                        if '$# akick' in b:
-                            b = b[:b.find('$#')]
-                            if b.endswith('!*@*'):
-                                b = b[:-4]
-                            self.actions.append('quote cs akick %s del %s' % (self.channel, b))
-                        else:
-                            self.actions.append('mode %s -b %s' % (self.channel, b))
-
-            for b in quiets[self.channel]:
-                if self.match(b):
-                    if self.do_bans:
-                        xchat.emit_print('Server Text', b + ' (quiet)')
-                    else:
-                        self.actions.append('mode %s -q %s' % (self.channel, b))
-
-        # Perform all registered actions
+            lists = (net.bans[self.key], net.akicks[self.key], net.quiets[self.key])
+            candidates = [list(banlist.candidates(self)) for banlist in lists]
+            found = ([], [], [])
+            total = sum([len(bans) for bans in candidates])
+            done = 0
+            for banlist, bans, matched in zip(lists, candidates, found):
+                for step in banlist.match_steps(self, bans, matched):
+                    done += 1
+                    yield done, total
+
+            for b in found[0]:
+                if self.do_bans:
+                    xchat.emit_print('Server Text', b)
+                else:
+                    self.actions.append('mode %s -b %s' % (self.channel, b.replace('%', '%%')))
+
+            for akick in net.akicks[self.key].unexpired(found[1]):
+                if self.do_bans:
+                    xchat.emit_print('Server Text', str(akick))
+                else:
+                    if not self.dry_run:
+                        net.akicks[self.key].discard(akick)
+                    self.actions.append('quote cs akick %s del %s' % (self.channel, akick.mask.replace('%', '%%')))
+
+            for b in found[2]:
+                if self.do_bans:
+                    xchat.emit_print('Server Text', b + ' (quiet)')
+                else:
+                    self.actions.append('mode %s -q %s' % (self.channel, b.replace('%', '%%')))
+
+        if self.do_hits:
+            members = channel_members(net, self.context, self.channel)
+            lists = [('', net.bans[self.key]), (' (quiet)', net.quiets[self.key])]
+            hits = ({}, {})
+            total = sum([len(members) + len(banlist.wildcards()) for label, banlist in lists])
+            done = 0
+            for (label, banlist), hit in zip(lists, hits):
+                for step in hit_steps(net, banlist, members, hit):
+                    done += 1
+                    yield done, total
+            xchat.emit_print('Server Text', "Members of %s hit by its bans and quiets" % self.channel)
+            show_hits(net, members, lists, everything=False, hits=hits)
+
+        if self.do_audit:
+            audit = Audit(net, self.key, network_of(self.context), time.time())
+            for progress in audit.steps():
+                yield progress
+            for line in audit.lines(self.channel):
+                xchat.emit_print('Server Text', line)
+            if self.audit_clean:
+                self.actions += audit.commands()
+
+    def perform(self):
+        """Perform all registered actions"""
+        kwargs = dict(self.__dict__.items())
+        net = self.net
+        commands = []
         for action in self.actions:
             if '%(target_account)s' in action and not self.target_account:
                 xchat.emit_print('Server Text', "Can't do an account ban for %s, not identified" % self.target_nick)
                 continue
             action = action % kwargs
-            if self.channel in can_do_akick and self.timer and ' +b ' in action:
+            if self.key in net.can_do_akick and self.timer and ' +b ' in action:
                 timer = math.ceil(self.timer/60.0)
                 ban = action.split()[-1]
-                self.context.command("chanserv akick %s ADD %s !T %d" % (self.channel, ban, timer))
+                commands.append("chanserv akick %s ADD %s !T %d" % (self.channel, ban, timer))
+                if self.key in net.bans_fetched and not self.dry_run:
+                    # Chanserv drops it by itself when it expires
+                    net.akicks[self.key].add(Akick(ban, '', self.me, time.time() + timer * 60))
             else:
-                self.context.command(action)
+                commands.append(action)
+                mode = _single_mode.match(action)
+                if self.timer and mode and mode.group(2) in ('+b', '+q') and not self.dry_run:
+                    expiries.add(network_of(self.context), self.key, mode.group(2)[1], mode.group(3), time.time() + self.timer)
+        arm_expiry()
+        if self.batch:
+            self.batch.commands += commands
+        elif self.dry_run:
+            preview(net, self.context, self.channel, commands)
+        else:
+            send_commands(net, self.context, self.channel, commands)
 
+        if debug:
+            xchat.emit_print('Server Text', str(net.ban_matchers))
         self.done()
 
     def done(self):
@@ -398,72 +884,779 @@ class Action(object):
         # Done!
         if debug:
             xchat.emit_print('Server Text', "Done " + str(self))
-        pending.remove(self)
-
-        # Deop?
-        if not self.am_op or not self.needs_op:
-            return
-
-        for p in pending:
-            if p.channel == self.channel and p.needs_op or not p.deop:
-                self.deop = False
-                break
-
-        if self.deop:
-            self.context.command("chanserv deop %s" % self.channel)
-
-        # Schedule removal?
-        if self.timer and (self.channel not in can_do_akick or self.banmode == 'q'):
-            action = Action(self.channel, self.me, self.context)
-            action.deop = self.deop
-            action.actions = [x.replace('+','-',1) for x in self.actions]
-            action.target = self.target
-            action.target_nick = self.target_nick
-            action.target_ident = self.target_ident
-            action.target_host = self.target_host
-            action.target_name = self.target_name
-            action.target_name_bannable = self.target_name_bannable
-            action.target_account = self.target_account
-            action.resolved = True
-            action.banmode = self.banmode
-            action.needs_op = True
-            xchat.hook_timer(self.timer * 1000, lambda act: act.schedule(update_stamp=True) and False, action)
+        self.cancel()
+
+    def cancel(self):
+        """Forget about this action, its batch goes on without it"""
+        pending, waiting = self.net.pending, self.net.waiting
+        if self in pending:
+            pending.remove(self)
+        for fact in self.waiting_on:
+            if self in waiting.get(fact, []):
+                waiting[fact].remove(self)
+                if not waiting[fact]:
+                    del waiting[fact]
+        self.waiting_on = set()
+        self.finished = True
+        if self.lease:
+            self.lease.release(self)
+            self.lease = None
+        if self.batch and self in self.batch.running:
+            self.batch.finished(self)
+
+    def subject(self):
+        """The target, ready for matching. Only lowercased once, not for every ban."""
+        target = (self.target_nick, self.target_ident, self.target_host, self.target_name, self.target_account)
+        if target != self.match_target:
+            self.match_target = target
+            self.match_subject = subject(self.net, *target)
+        return self.match_subject
 
     def match(self, ban):
         """Does a ban match this action"""
-        if ban.startswith('$r:') and self.target_name:
-            return ban2re(ban[3:]).match(self.target_name)
-        elif ban.startswith('$a:') and self.target_account:
-            return ban2re(ban[3:]).match(self.target_account)
-        else:
-            if '#' in ban:
-                ban = ban[:ban.find('$#')]
-            return ban2re(ban).match('%s!%s@%s' % (self.target_nick, self.target_ident, self.target_host))
-
-def run_pending(just_opped = None):
-    """Check all actions and run them if all information is there"""
-    now = time.time()
+        return self.net.ban_matchers.get(ban).match(self.subject())
+
+class Batch(object):
+    """Actions on several targets in one channel, sharing their mode lines"""
+    def __init__(self, actions, members):
+        self.actions = actions
+        self.running = list(actions)
+        self.members = members
+        self.commands = []
+        self.fetch_members = False
+        for action in actions:
+            action.batch = self
+
+    def schedule(self):
+        for action in self.actions:
+            action.schedule()
+        if self.fetch_members:
+            fetch_members(self.actions[0].net, self.actions[0].context, self.actions[0].channel)
+        return xchat.EAT_ALL
 
-    for p in pending:
-        if p.channel == just_opped:
+    def finished(self, action):
+        """Send everything once all actions are done"""
+        self.running.remove(action)
+        if self.running:
+            return
+        net, context, channel = self.actions[0].net, self.actions[0].context, self.actions[0].channel
+        if self.actions[0].dry_run:
+            preview(net, context, channel, self.commands)
+        else:
+            send_commands(net, context, channel, self.commands)
+
+class Job(object):
+    """An action going through large ban lists, in steps of job_step seconds
+    from a timer. steps is the action's plan, a generator yielding (done,
+    total); the action performs once it is exhausted. Every step keeps the
+    action from timing out, /cs cancel stops it."""
+    def __init__(self, action, steps):
+        self.action = action
+        self.steps = steps
+        self.done, self.total = 0, 0
+        self.reported = time.time()
+        action.net.jobs.append(self)
+        self.timer = xchat.hook_timer(job_pause, self.step)
+
+    def step(self, userdata=None):
+        action = self.action
+        if action.finished:
+            self.stop(False)
+            return False
+        if self.steps is None:
+            # Performing gets a step of its own
+            self.stop(False)
+            action.perform()
+            return False
+        end = time.time() + job_step
+        try:
+            while True:
+                self.done, self.total = next(self.steps)
+                if time.time() >= end:
+                    break
+        except StopIteration:
+            self.steps = None
+        action.stamp = time.time()
+        add_timeout(action)
+        if action.stamp - self.reported >= job_report:
+            self.reported = action.stamp
+            action.context.emit_print('Server Text', "%s: %d%% done, /cs cancel stops it" %
+                    (action.describe(), 100 * self.done // max(self.total, 1)))
+        return True
+
+    def stop(self, unhook=True):
+        """Stop stepping, from outside the timer unless unhook is False"""
+        if self in self.action.net.jobs:
+            self.action.net.jobs.remove(self)
+        if self.timer and unhook:
+            xchat.unhook(self.timer)
+        self.timer = None
+
+    def cancel(self):
+        """Stop and give up on the action"""
+        self.stop()
+        self.action.done()
+
+class OpLease(object):
+    """Op in a channel, shared by all actions that need it
+
+    The first action asks chanserv for op, later ones wait for that same
+    request. When the last one is done we stay opped for op_linger seconds,
+    and every action in that time extends the lease. Only then do we deop,
+    and only if we weren't opped before the lease started. If the last one
+    gives up while op is still on its way, the lease waits action_timeout
+    seconds for it, so a late op is still followed by a deop."""
+    def __init__(self, net, context, channel, deop=True):
+        self.net = net
+        self.context = context
+        self.channel = channel
+        self.key = net.key(channel)
+        self.deop = deop
+        self.holders = set()
+        self.requested = False
+        self.timer = None
+
+    def acquire(self, action):
+        self.holders.add(action)
+        if self.timer:
+            xchat.unhook(self.timer)
+            self.timer = None
+        if not action.am_op and not self.requested:
+            send(self.net, self.context, "chanserv op %s" % self.channel)
+            stats.begin(('op', self.key))
+            self.requested = True
+
+    def opped(self):
+        self.requested = False
+        if not self.holders:
+            if self.timer:
+                xchat.unhook(self.timer)
+            self.timer = xchat.hook_timer(int(op_linger * 1000), self.expire)
+
+    def release(self, action):
+        self.holders.discard(action)
+        if self.holders or self.timer:
+            return
+        if self.requested:
+            self.timer = xchat.hook_timer(int(action_timeout * 1000), self.refused)
+            return
+        self.timer = xchat.hook_timer(int(op_linger * 1000), self.expire)
+
+    def refused(self, userdata=None):
+        """Chanserv never opped us, let the next action ask again"""
+        self.timer = None
+        if not self.holders and self.requested and self.net.leases.get(self.key) is self:
+            del self.net.leases[self.key]
+        return False
+
+    def expire(self, userdata=None):
+        self.timer = None
+        net = self.net
+        if not self.holders and net.leases.get(self.key) is self:
+            del net.leases[self.key]
+            me = net.key(self.context.get_info('nick'))
+            if self.deop and '@' in channel_members(net, self.context, self.channel).get(me, no_member).prefix:
+                stats.count('deops')
+                send(net, self.context, "chanserv deop %s" % self.channel)
+        return False
+
+    def end(self):
+        """Forget the lease without deopping"""
+        if self.timer:
+            xchat.unhook(self.timer)
+            self.timer = None
+
+def wait(action):
+    """Run an action if it has everything it needs, or wait for what's missing"""
+    if action.finished:
+        return
+    if not action.resolved and action.target_nick in action.net.users:
+        action.resolve_nick(request = False)
+    facts = action.waits_for()
+    if not facts:
+        action.run()
+        return
+    for fact in facts:
+        if fact not in action.waiting_on:
+            action.waiting_on.add(fact)
+            action.net.waiting[fact].append(action)
+
+def run_pending(net, fact):
+    """Wake up the actions of a connection waiting for a fact"""
+    stats.count('run_pending')
+    stats.end(fact)
+    expire_pending()
+    if fact[0] == 'op' and fact[1] in net.leases:
+        net.leases[fact[1]].opped()
+    for p in net.waiting.pop(fact, []):
+        p.waiting_on.discard(fact)
+        if fact[0] == 'op':
             p.am_op = True
+        wait(p)
+
+def add_timeout(action):
+    """Give up on an action if it's still waiting after action_timeout seconds"""
+    global timeout_timer
+    heapq.heappush(timeouts, (action.stamp + action_timeout, next(timeout_seq), action))
+    if not timeout_timer:
+        timeout_timer = xchat.hook_timer(1000, expire_pending, True)
+
+def expire_pending(userdata=None):
+    """Time out actions that have waited too long"""
+    global timeout_timer
+    now = time.time()
+    while timeouts and timeouts[0][0] < now:
+        deadline, seq, p = heapq.heappop(timeouts)
+        if not p.finished and p.stamp + action_timeout == deadline:
+            stats.count('timeouts')
+            p.done()
+    if timeouts or not userdata:
+        return True
+    timeout_timer = None
+    return False
+
+# Outbound command queue
+URGENT, NORMAL, BULK = range(3)
+lane_names = ('urgent', 'normal', 'bulk')
+# Per network (burst, lines per second) budget, None is the default
+flood_limits = {None: (5, 1.0)}
+
+class CommandQueue(object):
+    """Token bucket limited queue of outgoing commands for one network
+
+    Commands go out in priority order: kicks and mode changes first, then
+    chanserv requests and whois lookups, then ban list fetches. A command
+    that is already waiting in the queue is not queued a second time."""
+    def __init__(self, network, id=None):
+        self.network = network
+        self.id = id
+        self.burst, self.rate = flood_limits.get(network, flood_limits[None])
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lanes = [collections.deque() for lane in lane_names]
+        self.queued = set()
+        self.timer = None
+        self.sent = [0] * len(lane_names)
+        self.waited = [0.0] * len(lane_names)
+        self.max_wait = [0.0] * len(lane_names)
+        self.max_depth = self.coalesced = 0
+
+    def send(self, context, command, lane):
+        if command in self.queued:
+            self.coalesced += 1
+            return
+        self.queued.add(command)
+        self.lanes[lane].append((context, command, time.time()))
+        self.max_depth = max(self.max_depth, len(self.queued))
+        self.flush()
+
+    def flush(self, userdata=None):
+        """Send as much as the budget allows and come back later for the rest"""
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        for lane, queue in enumerate(self.lanes):
+            while queue and self.tokens >= 1:
+                context, command, stamp = queue.popleft()
+                self.queued.discard(command)
+                self.tokens -= 1
+                self.sent[lane] += 1
+                self.waited[lane] += now - stamp
+                self.max_wait[lane] = max(self.max_wait[lane], now - stamp)
+                context.command(command)
+                if recorder:
+                    recorder.write(self.id, '>', command)
+                if stats.started:
+                    # A /cs that failed sends nothing, don't count what comes much later
+                    if now - stats.started < action_timeout:
+                        stats.measure('first line', now - stats.started)
+                    stats.started = None
+        if userdata is not None:
+            self.timer = None
+        if self.queued and not self.timer:
+            self.timer = xchat.hook_timer(int(math.ceil((1 - self.tokens) / self.rate * 1000)), self.flush, True)
+        return False
+
+    def clear(self):
+        """Drop everything that hasn't been sent yet"""
+        for queue in self.lanes:
+            queue.clear()
+        self.queued.clear()
+        if self.timer:
+            xchat.unhook(self.timer)
+            self.timer = None
+
+    def stats(self):
+        yield "Outbound queue for %s: %d queued (max %d), %d sent, %d coalesced, %.1f/%d tokens, %.1f lines/s" % (
+                self.network, len(self.queued), self.max_depth, sum(self.sent), self.coalesced, self.tokens, self.burst, self.rate)
+        for lane, name in enumerate(lane_names):
+            yield "  %-6s: %d queued, %d sent, wait avg %.2fs max %.2fs" % (name, len(self.lanes[lane]), self.sent[lane],
+                    self.waited[lane] / max(1, self.sent[lane]), self.max_wait[lane])
+
+def send(net, context, command, lane=None):
+    """Queue a command for sending to the server of a connection, through
+    one of its contexts"""
+    if lane is None:
+        lane = URGENT if command.split(None, 1)[0].lower() in ('remove', 'kick', 'mode') else NORMAL
+    if not net.queue:
+        net.queue = CommandQueue(context.get_info('network'), net.id)
+    net.queue.send(context, command, lane)
+
+# Instrumentation
+latency_bounds = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+size_bounds = (10, 30, 100, 300, 1000, 3000, 10000)
+class Histogram(object):
+    """How many values fell in each bucket, by upper bound of the bucket"""
+    def __init__(self, bounds=latency_bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = self.max = 0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket the value at this fraction falls in"""
+        seen = 0
+        for bound, count in zip(self.bounds + (self.max,), self.buckets):
+            seen += count
+            if seen >= fraction * self.count:
+                return min(bound, self.max)
+
+    def as_dict(self):
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'buckets': dict(zip([str(b) for b in self.bounds] + ['inf'], self.buckets))}
+
+class Stats(object):
+    """Counters, and histograms of how long facts take to arrive after we
+    ask for them (op, whois, bans), keyed by the kind of fact"""
+    histograms = (('first line', "/cs to first line sent", latency_bounds),
+                  ('op', "Waiting for op", latency_bounds),
+                  ('whois', "Whois", latency_bounds),
+                  ('bans', "Fetching ban lists", latency_bounds),
+                  ('ban list size', "Ban list size", size_bounds))
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.since = time.time()
+        self.counters = collections.defaultdict(int)
+        self.values = dict([(name, Histogram(bounds)) for name, label, bounds in self.histograms])
+        self.asked = {}
+        self.started = None
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def measure(self, name, value):
+        self.values[name].add(value)
+
+    def begin(self, fact):
+        """We asked for a fact, remember when"""
+        if len(self.asked) > 1000:
+            # Answers that never came
+            self.asked.clear()
+        self.asked.setdefault(fact, time.time())
+
+    def end(self, fact):
+        if fact in self.asked:
+            self.measure(fact[0], time.time() - self.asked.pop(fact))
+
+    def lines(self):
+        yield "Since %s:" % time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.since))
+        for name, label, bounds in self.histograms:
+            h = self.values[name]
+            if not h.count:
+                yield "  %-24s: -" % label
+            elif bounds is size_bounds:
+                yield "  %-24s: %d, avg %.0f, p50 <= %d, p90 <= %d, max %d" % (label, h.count,
+                        h.total / h.count, h.percentile(0.5), h.percentile(0.9), h.max)
+            else:
+                yield "  %-24s: %d, avg %.2fs, p50 <= %.2fs, p90 <= %.2fs, max %.2fs" % (label, h.count,
+                        h.total / h.count, h.percentile(0.5), h.percentile(0.9), h.max)
+        yield "  run_pending calls       : %d" % self.counters['run_pending']
+        yield "  Timed out actions       : %d" % self.counters['timeouts']
+        yield "  Ops granted, deops      : %d, %d" % (self.values['op'].count, self.counters['deops'])
+        for net in connections.values():
+            yield "  " + str(net.ban_matchers)
+
+    def as_dict(self):
+        return {'version': __module_version__, 'since': self.since, 'time': time.time(),
+                'counters': dict(self.counters),
+                'histograms': dict([(name, h.as_dict()) for name, h in self.values.items()])}
+stats = Stats()
+
+def write_stats(userdata=None):
+    """Dump the stats as json, for comparing them across versions"""
+    path = os.path.join(xchat.get_info('xchatdir'), 'chanserv.py-stats.json')
+    try:
+        fd = open(path, 'w')
+        fd.write(json.dumps(stats.as_dict(), sort_keys=True, indent=1))
+        fd.close()
+    except (IOError, OSError):
+        xchat.emit_print('Server Error', "Can't write %s" % path)
+    return True
+if dump_stats:
+    xchat.hook_timer(stats_interval * 1000, write_stats)
+
+class Recorder(object):
+    """Writes down what the script sees and does, for bench/replay.py to
+    replay offline. After a header line, one line per event: milliseconds
+    since recording started, the id of the connection, the kind of event
+    and the event itself.
+
+      = ExampleNet irc.example.net me       network, server and our nick, once
+      < :irc.example.net 367 me #chan ...   a line from the server
+      / #chan unban nick                    a /cs typed in a channel
+      ! Disconnected                        a print event we hook
+      > mode #chan -b *!*@host              a line we sent"""
+    def __init__(self, path):
+        self.path = path
+        self.fd = open(path, 'a', 1)
+        self.start = time.time()
+        self.seen = set()
+        self.fd.write('# chanserv.py %s recording, started %.3f\n' % (__module_version__, self.start))
+        for c in xchat.get_list('channels'):
+            if c.type == 1:
+                self.introduce(c.id, c.context)
+
+    def introduce(self, id, context):
+        self.seen.add(id)
+        self.write(id, '=', '%s %s %s' % (network_of(context), context.get_info('server'), context.get_info('nick')))
+
+    def write(self, id, kind, text):
+        self.fd.write('%d %s %s %s\n' % ((time.time() - self.start) * 1000, id, kind, text))
+
+    def event(self, kind, text):
+        """Write down something that happened in the current context"""
+        id = xchat.get_prefs('id')
+        if id not in self.seen:
+            self.introduce(id, xchat.get_context())
+        self.write(id, kind, text)
+
+recorder = None
+
+def start_recording(path):
+    """Record everything from now on, until the script is unloaded"""
+    global recorder
+    try:
+        recorder = Recorder(path)
+    except (IOError, OSError):
+        xchat.emit_print('Server Error', "Can't write %s, not recording" % path)
+        return
+    xchat.hook_server('RAW LINE', lambda word, word_eol, userdata: recorder.event('<', word_eol[0]), priority=xchat.PRI_HIGHEST)
+    xchat.hook_print('Disconnected', lambda word, userdata: recorder.event('!', 'Disconnected'), priority=xchat.PRI_HIGHEST)
+    xchat.emit_print('Server Text', "Recording to %s" % path)
 
-        if p.target_nick in users and not p.resolved:
-            p.resolve_nick(request = False)
+# Helper functions
+casemappings = {'ascii': ('', ''), 'rfc1459': ('[]\\~', '{}|^'), 'strict-rfc1459': ('[]\\', '{}|')}
+try:
+    maketrans = str.maketrans
+except AttributeError:
+    from string import maketrans
+lower_tables = dict([(name, maketrans(*chars)) for name, chars in casemappings.items()])
+max_keys = 50000 # Per connection, see Connection.key
+
+def subject(net, nick, ident, host, name, account):
+    """What masks are matched against: nick!ident@host, its parts, realname
+    and account, all lowercased the way the server of a connection does"""
+    lower = net.lower
+    nick, ident, host = [lower(str(x)) for x in (nick, ident, host)]
+    return ('%s!%s@%s' % (nick, ident, host), nick, ident, host,
+            name and lower(name), account and lower(account))
+
+def compile_part(pattern, index):
+    """Test one part of a subject with a string comparison, None if that can't be done"""
+    if '?' in pattern:
+        return None
+    stars = pattern.count('*')
+    if pattern and stars == len(pattern):
+        return True
+    if stars == 0:
+        return lambda subject: subject[index] == pattern
+    if stars == 1 and pattern.endswith('*'):
+        pattern = pattern[:-1]
+        return lambda subject: subject[index].startswith(pattern)
+    if stars == 1 and pattern.startswith('*'):
+        pattern = pattern[1:]
+        return lambda subject: subject[index].endswith(pattern)
+    return None
+
+class MaskMatcher(object):
+    """A compiled ban
+
+    Bans whose nick, ident and host parts are literals, '*', or have a single
+    leading or trailing '*' (*!*@host, nick!*@*, *!ident@*, *!*@*.isp.net)
+    are matched part by part with string comparisons. Only other wildcards
+    fall back to a regex. lower is the lowercasing of the server the ban is
+    for."""
+    def __init__(self, ban, lower):
+        self.kind, mask = ban_kind(ban)
+        mask = lower(mask)
+        # match is set per instance, so matching a subject is a single call
+        if self.kind in ('$r', '$a'):
+            index = self.kind == '$r' and 4 or 5
+            test = compile_part(mask, index)
+            if test is None:
+                regex = ban2re(mask)
+                self.match = lambda subject: bool(subject[index]) and regex.match(subject[index]) is not None
+            elif test is True:
+                self.match = lambda subject: bool(subject[index])
+            else:
+                self.match = lambda subject: bool(subject[index]) and test(subject)
+            return
+        tests = [None]
+        if mask.count('!') == 1 and mask.count('@') == 1 and mask.find('!') < mask.find('@'):
+            tests = [compile_part(part, index) for index, part in zip((1, 2, 3), re.split('[!@]', mask))]
+        if None in tests:
+            regex = ban2re(mask)
+            self.match = lambda subject: regex.match(subject[0]) is not None
+            return
+        tests = [test for test in tests if test is not True]
+        if not tests:
+            self.match = lambda subject: True
+        elif len(tests) == 1:
+            self.match = tests[0]
+        else:
+            self.match = lambda subject: all([test(subject) for test in tests])
+
+class BanMatchers(object):
+    """Bounded LRU cache of compiled bans, keyed by the ban, which includes
+    its kind ($r:, $a: or $#). One per connection, as casemappings differ."""
+    def __init__(self, lower, size=4096):
+        self.lower = lower
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def get(self, ban):
+        entries = self.entries
+        if ban in entries:
+            self.hits += 1
+            if hasattr(entries, 'move_to_end'):
+                entries.move_to_end(ban)
+            else:
+                entries[ban] = entries.pop(ban)
+            return entries[ban]
+        self.misses += 1
+        if len(entries) >= self.size:
+            entries.popitem(last=False)
+        entries[ban] = matcher = MaskMatcher(ban, self.lower)
+        return matcher
 
-        # Timeout?
-        if p.stamp < now - 10:
-            p.done()
-            continue
+    def __str__(self):
+        return "%d ban masks cached, %d hits, %d misses" % (len(self.entries), self.hits, self.misses)
 
-        can_run = not (p.channel in collecting_bans and (p.do_unban or p.do_bans))
-        if can_run and p.resolved and (p.am_op or not p.needs_op):
-            p.run()
+def ban_kind(ban):
+    """Split a ban into its kind ($r, $a, $# or nothing) and its mask"""
+    if ban.startswith('$r:') or ban.startswith('$a:'):
+        return ban[:2], ban[3:]
+    if '$#' in ban:
+        return '$#', ban[:ban.find('$#')]
+    return '', ban
 
-# Helper functions
 def ban2re(data):
     return re.compile('^' + re.escape(data).replace(r'\*','.*').replace(r'\?','.') + '$')
 
+_wildcard = re.compile(r'[*?]')
+class BanList(object):
+    """A channel's ban or quiet list, indexed by the literal parts of each mask
+
+    Every mask is filed under its most selective literal part: the whole
+    mask, the host, nick or ident, a host prefix or suffix, or the account or
+    realname of an extban. Whatever is left is a true wildcard and is always
+    checked. Finding the bans that hit a user then only needs a full match
+    on the candidates from the buckets that user's details point at."""
+    def __init__(self, lower):
+        self.lower = lower
+        self.entries = collections.OrderedDict()
+        # Who set each ban and when, if the server told us
+        self.set_by = {}
+        self.buckets = collections.defaultdict(dict)
+        self.prefix_lengths = set()
+        self.suffix_lengths = set()
+        self.seq = 0
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, ban):
+        return ban in self.entries
+
+    def classify(self, ban):
+        """Find the bucket and key a ban is filed under"""
+        kind, mask = ban_kind(ban)
+        mask = self.lower(mask)
+        if kind in ('$a', '$r'):
+            if _wildcard.search(mask):
+                return kind, None
+            return kind, mask
+        if mask.count('!') != 1 or mask.count('@') != 1 or mask.find('!') > mask.find('@'):
+            return None, None
+        if not _wildcard.search(mask):
+            return 'exact', mask
+        nick, ident, host = re.split('[!@]', mask)
+        if not _wildcard.search(host):
+            return 'host', host
+        if not _wildcard.search(nick):
+            return 'nick', nick
+        if not _wildcard.search(ident):
+            return 'ident', ident
+        prefix = _wildcard.split(host, 1)[0]
+        suffix = _wildcard.split(host)[-1]
+        if len(prefix) >= 3 and len(prefix) >= len(suffix):
+            self.prefix_lengths.add(len(prefix))
+            return 'prefix', prefix
+        if len(suffix) >= 3:
+            self.suffix_lengths.add(len(suffix))
+            return 'suffix', suffix
+        return None, None
+
+    def append(self, ban, setter=None, stamp=None):
+        if ban in self.entries:
+            return
+        bucket, key = self.classify(ban)
+        self.entries[ban] = (self.seq, bucket, key)
+        self.buckets[bucket].setdefault(key, []).append(ban)
+        self.seq += 1
+        if setter:
+            self.set_by[ban] = (setter, stamp)
+
+    def remove(self, ban):
+        if ban not in self.entries:
+            return
+        self.set_by.pop(ban, None)
+        seq, bucket, key = self.entries.pop(ban)
+        entries = self.buckets[bucket][key]
+        entries.remove(ban)
+        if not entries:
+            del self.buckets[bucket][key]
+
+    def candidates(self, action):
+        """All bans that could possibly match an action's target"""
+        return self.candidates_for(action.subject())
+
+    def candidates_for(self, subject, wildcards=True):
+        """All bans that could possibly match a subject, optionally leaving
+        out the ones that are wildcards all over"""
+        mask, nick, ident, host, name, account = subject
+        lookups = [('exact', mask), ('host', host), ('nick', nick), ('ident', ident)]
+        if wildcards:
+            lookups.append((None, None))
+        lookups += [('prefix', host[:l]) for l in self.prefix_lengths if l <= len(host)]
+        lookups += [('suffix', host[-l:]) for l in self.suffix_lengths if l <= len(host)]
+        if account:
+            lookups += [('$a', account), ('$a', None)]
+        if name:
+            lookups += [('$r', name), ('$r', None)]
+        buckets = self.buckets
+        for bucket, key in lookups:
+            if bucket in buckets and key in buckets[bucket]:
+                for ban in buckets[bucket][key]:
+                    yield ban
+
+    def wildcards(self):
+        """The bans that are wildcards all over, the index can't file them"""
+        return self.buckets.get(None, {}).get(None, [])
+
+    def matches(self, action):
+        """All bans that match an action's target, in list order"""
+        found = []
+        for step in self.match_steps(action, list(self.candidates(action)), found):
+            pass
+        return found
+
+    def match_steps(self, action, candidates, found):
+        """matches, one candidate at a time: the matching ones go into found,
+        in list order once the generator is exhausted. The list may change
+        in between, bans lifted meanwhile are left out."""
+        seqs = dict([(ban, self.entries[ban][0]) for ban in candidates if ban in self.entries])
+        for ban in candidates:
+            if action.match(ban):
+                found.append(ban)
+            yield
+        found[:] = [ban for ban in found if ban in self.entries]
+        found.sort(key=lambda ban: seqs.get(ban, self.seq))
+
+def longest_literal(mask):
+    """The longest part of a mask without wildcards"""
+    return max(_wildcard.split(mask), key=len)
+
+class MaskText(object):
+    """Many strings joined into one, to find the ones that contain a literal
+    part of a mask with one string search instead of a test for each"""
+    def __init__(self, items, strings):
+        self.items = items
+        self.text = '\n'.join(strings)
+        self.starts = [0]
+        for string in strings:
+            self.starts.append(self.starts[-1] + len(string) + 1)
+
+    def containing(self, literal):
+        """The items whose string contains a literal, all of them if it's too
+        short to be worth searching for"""
+        if len(literal) < 3:
+            return self.items
+        found, pos = [], self.text.find(literal)
+        while pos != -1:
+            line = bisect.bisect_right(self.starts, pos) - 1
+            found.append(self.items[line])
+            pos = self.text.find(literal, self.starts[line + 1])
+        return found
+
+class Akick(object):
+    """An entry of chanserv's akick list: a mask or account name, why and by
+    whom it was added and when it expires, if ever"""
+    def __init__(self, mask, reason, setter, expires=None):
+        self.mask = mask; self.reason = reason; self.setter = setter; self.expires = expires
+        if '!' not in mask and '@' not in mask and not mask.startswith('$'):
+            self.ban = '$a:' + mask
+        elif '!' not in mask and '@' in mask:
+            self.ban = '*!' + mask
+        else:
+            self.ban = mask
+
+    def __str__(self):
+        expires = ''
+        if self.expires:
+            expires = ', expires in %dm' % max(0, math.ceil((self.expires - time.time()) / 60))
+        return ("%s (akick by %s%s) %s" % (self.mask, self.setter, expires, self.reason)).strip()
+
+class AkickList(BanList):
+    """A channel's akicks, indexed like bans by what they match"""
+    def __init__(self, lower):
+        BanList.__init__(self, lower)
+        self.akicks = {}
+
+    def add(self, akick):
+        self.akicks[akick.ban] = akick
+        self.append(akick.ban)
+
+    def discard(self, akick):
+        self.akicks.pop(akick.ban, None)
+        self.remove(akick.ban)
+
+    def matching(self, action):
+        """The akicks that match an action's target, minus the expired ones"""
+        return self.unexpired(self.matches(action))
+
+    def unexpired(self, bans):
+        """The akicks for some bans, minus the expired and removed ones"""
+        now = time.time()
+        akicks = [self.akicks.get(ban) for ban in bans]
+        return [akick for akick in akicks if akick and (not akick.expires or akick.expires > now)]
+
 _valid_nickname = re.compile(r'^[-a-zA-Z0-9\[\]{}`|_^\\]{0,30}$')
 valid_nickname = lambda data: _valid_nickname.match(data)
 _valid_channel = re.compile(r'^[#~].*') # OK, this is cheating
@@ -471,85 +1664,948 @@ valid_channel = lambda data: _valid_channel.match(data)
 _valid_mask = re.compile(r'^([-a-zA-Z0-9\[\]{}`|_^\\*?]{0,30}!.*?@.*?|\$[ar]:.*)$')
 valid_mask = lambda data: _valid_mask.match(data)
 
+def bans_age(net, channel):
+    """How long ago the ban lists of a channel were fetched"""
+    if channel not in net.bans_fetched:
+        return float('inf')
+    return time.time() - net.bans_fetched[channel]
+
+def ban_list_size(net, channel):
+    """The number of bans, quiets and akicks of a channel"""
+    return len(net.bans[channel]) + len(net.quiets[channel]) + len(net.akicks[channel])
+
+def bans_collected(net, channel):
+    """All ban lists of a channel are in, run whatever waited for them"""
+    net.collecting_bans.discard(channel)
+    net.bans_fetched[channel] = time.time()
+    stats.measure('ban list size', ban_list_size(net, channel))
+    run_pending(net, ('bans', channel))
+
+def forget_channel(net, channel):
+    """Mark the ban lists and members of a channel as stale"""
+    if channel in net.leases:
+        net.leases.pop(channel).end()
+    net.roster.pop(channel, None)
+    net.members_fetched.pop(channel, None)
+    net.bans_fetched.pop(channel, None)
+    net.bans.pop(channel, None)
+    net.quiets.pop(channel, None)
+    net.akicks.pop(channel, None)
+
+stale_age = 90 * 86400 # Bans and quiets older than this are reported as stale
+audit_shown = 20 # Findings of each kind that /cs audit shows
+
+def covering_re(mask):
+    """A regex matching the masks that a mask covers. Its wildcards match
+    wildcards too, but a ? can't stand in for a *."""
+    return re.compile('^' + ''.join([c == '*' and '.*' or c == '?' and '[^*]' or re.escape(c) for c in mask]) + '$')
+
+def mask_subject(net, ban):
+    """A ban dressed up as a subject, so BanList.candidates_for finds the
+    bans that might cover it"""
+    kind, mask = ban_kind(ban)
+    mask = net.lower(mask)
+    if kind == '$a':
+        return ('', '', '', '', None, mask)
+    if kind == '$r':
+        return ('', '', '', '', mask, None)
+    if mask.count('!') != 1 or mask.count('@') != 1 or mask.find('!') > mask.find('@'):
+        return (mask, '', '', '', None, None)
+    return tuple([mask] + re.split('[!@]', mask) + [None, None])
+
+class Audit(object):
+    """Entries of a channel's ban, quiet and akick lists that could go
+
+    covered: (list, mask, broader mask of the same list)
+    duplicates: (list, mask, other list), for quiets that are also bans
+                and bans that are also akicks, chanserv sets those again
+    expired: (list, mask, seconds ago) for akicks and our own timed bans
+    stale: (list, mask, setter, age) for bans older than stale_age, these
+           are only reported
+
+    Finding covered masks doesn't compare all pairs: every mask only
+    looks at the candidates the index of its list gives for its literal
+    parts, as if it were a user. Masks that the index can't file go the
+    other way round and only look at the masks containing their longest
+    literal part."""
+    def __init__(self, net, channel, network, now):
+        self.net = net
+        self.channel = channel
+        bans, quiets, akicks = net.bans[channel], net.quiets[channel], net.akicks[channel]
+        self.sizes = (len(bans), len(quiets), len(akicks))
+        self.covered, self.duplicates, self.expired, self.stale = [], [], [], []
+
+        banned = set([net.lower(ban) for ban in bans])
+        for quiet in quiets:
+            if net.lower(quiet) in banned:
+                self.duplicates.append(('quiet', quiet, 'ban'))
+        akicked = dict([(net.lower(ban), akick) for ban, akick in akicks.akicks.items()])
+        for ban in bans:
+            if net.lower(ban) in akicked:
+                self.duplicates.append(('ban', ban, 'akick'))
+        for akick in akicks.akicks.values():
+            if akick.expires and akick.expires <= now:
+                self.expired.append(('akick', akick.ban, now - akick.expires))
+        for key, due in expiries.due.items():
+            if key[:2] == (network, channel) and due <= now and key[2] in 'bq':
+                kind, banlist = key[2] == 'b' and ('ban', bans) or ('quiet', quiets)
+                if key[3] in banlist:
+                    self.expired.append((kind, key[3], now - due))
+        for kind, banlist in (('ban', bans), ('quiet', quiets)):
+            for ban, (setter, stamp) in banlist.set_by.items():
+                if stamp and stamp < now - stale_age:
+                    self.stale.append((kind, ban, setter, now - stamp))
+
+        self.gone = set([(kind, mask) for kind, mask, other in self.duplicates] +
+                        [(kind, mask) for kind, mask, ago in self.expired])
+        self.lists = (('ban', bans), ('quiet', quiets), ('akick', akicks))
+
+    def steps(self):
+        """Find the covered masks, the only part that takes a while.
+        Yields (done, total) after every mask, so it can be spread out."""
+        total = sum([len(banlist) + len(banlist.wildcards()) for kind, banlist in self.lists])
+        done = 0
+        for kind, banlist in self.lists:
+            for step in self.find_covered(banlist, kind):
+                done += 1
+                yield done, total
+
+    def find_covered(self, banlist, kind):
+        """Add every mask of a list that another one covers to covered,
+        leaving out the ones that go anyway. Yields after every mask."""
+        net = self.net
+        # The list may change between steps, so go through it as it is now
+        bans = list(banlist)
+        seqs = dict([(ban, banlist.entries[ban][0]) for ban in bans])
+        usable = [ban for ban in bans if ban_kind(ban)[0] != '$#' and (kind, ban) not in self.gone]
+        lowered = dict([(ban, net.lower(ban)) for ban in usable])
+        regexes = {}
+        def covers(general, specific):
+            if general not in regexes:
+                regexes[general] = covering_re(lowered[general])
+            return regexes[general].match(lowered[specific]) is not None
+        found = {}
+        def check(ban, other):
+            if ban in found or other == ban or other not in lowered or not covers(other, ban):
+                return
+            # Of two masks that cover each other, the oldest stays
+            if covers(ban, other) and seqs[ban] < seqs[other]:
+                return
+            found[ban] = other
+
+        for ban in bans:
+            if ban in lowered:
+                for other in banlist.candidates_for(mask_subject(net, ban), wildcards=False):
+                    check(ban, other)
+                    if ban in found:
+                        break
+            yield
+
+        text = MaskText(usable, [lowered[ban] for ban in usable])
+        for other in list(banlist.wildcards()):
+            if other in lowered:
+                for ban in text.containing(longest_literal(lowered[other])):
+                    check(ban, other)
+            yield
+        self.covered += [(kind, ban, found[ban]) for ban in usable if ban in found]
+
+    def commands(self):
+        """Remove whatever is covered, duplicate or expired"""
+        channel = self.channel
+        found = [(kind, mask) for kind, mask, rest in self.covered + self.duplicates + self.expired]
+        commands = []
+        for kind, mask in found:
+            if kind == 'akick':
+                akick = self.net.akicks[channel].akicks.get(mask)
+                if akick:
+                    self.net.akicks[channel].discard(akick)
+                commands.append('quote cs akick %%(channel)s del %s' % (akick and akick.mask or mask).replace('%', '%%'))
+            else:
+                commands.append('mode %%(channel)s -%s %s' % (kind[0], mask.replace('%', '%%')))
+        return commands
+
+    def lines(self, channel):
+        maxlist = ''
+        for entry in self.net.isupport.get('MAXLIST', '').split(','):
+            if ':' in entry and 'b' in entry.split(':')[0]:
+                maxlist = ' of %s' % entry.split(':')[1]
+        yield "Audit of %s: %d bans, %d quiets, %d akicks, %d%s list entries in use" % (
+                (channel,) + self.sizes + (self.sizes[0] + self.sizes[1], maxlist))
+        found = [("Covered", self.covered, lambda kind, mask, by: "%s (%s) by %s" % (mask, kind, by)),
+                 ("Duplicate", self.duplicates, lambda kind, mask, other: "%s (%s) is on the %s list too" % (mask, kind, other)),
+                 ("Expired", self.expired, lambda kind, mask, ago: "%s (%s) %d minutes ago" % (mask, kind, ago / 60)),
+                 ("Stale", self.stale, lambda kind, mask, setter, age: "%s (%s) set by %s %d days ago" % (mask, kind, setter, age / 86400))]
+        for label, entries, show in found:
+            for entry in entries[:audit_shown]:
+                yield "  %s: %s" % (label, show(*entry))
+            if len(entries) > audit_shown:
+                yield "  %s: %d more" % (label, len(entries) - audit_shown)
+        slots = len([kind for kind, mask, rest in self.covered + self.duplicates + self.expired if kind != 'akick'])
+        yield "Removing %d covered, duplicate and expired entries frees %d list entries" % (
+                len(self.covered) + len(self.duplicates) + len(self.expired), slots)
+
+class ExpiryStore(object):
+    """When to lift timed bans and mutes, on disk so restarts don't forget them
+
+    Entries are (network, channel, mode, mask) with the time they are due,
+    mode being b or q. All of them are kept in memory as well, in a heap ordered by due time."""
+    def __init__(self, path):
+        self.due = {}
+        self.heap = []
+        # Entries a lift was sent for, in memory only
+        self.tried = set()
+        self.db = None
+        if sqlite3:
+            try:
+                self.db = sqlite3.connect(path)
+                self.db.execute("""CREATE TABLE IF NOT EXISTS expiry (network TEXT, channel TEXT, mode TEXT,
+                                   mask TEXT, due REAL, PRIMARY KEY (network, channel, mode, mask))""")
+                self.db.commit()
+                for row in self.db.execute("SELECT network, channel, mode, mask, due FROM expiry"):
+                    self.remember(tuple(row[:4]), row[4])
+            except sqlite3.Error:
+                xchat.emit_print('Server Error', "Can't use %s, timed bans won't survive a restart" % path)
+                self.db = None
+
+    def __len__(self):
+        return len(self.due)
+
+    def remember(self, key, due):
+        self.due[key] = due
+        heapq.heappush(self.heap, (due, key))
+
+    def add(self, network, channel, mode, mask, due):
+        self.remember((network, channel, mode, mask), due)
+        if self.db:
+            self.db.execute("INSERT OR REPLACE INTO expiry VALUES (?, ?, ?, ?, ?)", (network, channel, mode, mask, due))
+            self.db.commit()
+
+    def remove(self, keys):
+        self.tried.difference_update(keys)
+        keys = [key for key in keys if self.due.pop(key, None) is not None]
+        if self.db and keys:
+            self.db.executemany("DELETE FROM expiry WHERE network=? AND channel=? AND mode=? AND mask=?", keys)
+            self.db.commit()
+
+    def next_due(self):
+        """When the first entry is due, dropping removed entries on the way"""
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap and self.heap[0][0] or None
+
+    def pop_due(self, when):
+        """All entries due by then, they stay on disk until removed"""
+        found = []
+        while self.next_due() is not None and self.heap[0][0] <= when:
+            found.append(heapq.heappop(self.heap)[1])
+        return found
+
+    def overdue(self, network, channel, when):
+        return [key for key, due in self.due.items() if key[:2] == (network, channel) and due <= when]
+
+    def has(self, network, channel):
+        for key in self.due:
+            if key[:2] == (network, channel):
+                return True
+        return False
+expiries = ExpiryStore(os.path.join(xchat.get_info('xchatdir'), 'chanserv.py-expiry.db'))
+
+def network_of(context):
+    return context.get_info('network') or context.get_info('server')
+
+def arm_expiry():
+    """Make sure the expiry timer goes off when the next entry is due"""
+    global expiry_timer
+    due = expiries.next_due()
+    if expiry_timer:
+        if due is not None and expiry_timer[0] <= due:
+            return
+        xchat.unhook(expiry_timer[1])
+        expiry_timer = None
+    if due is not None:
+        delay = min(max(0, due - time.time()), expiry_longest)
+        expiry_timer = (time.time() + delay, xchat.hook_timer(int(math.ceil(delay * 1000)), expire_timed))
+
+def expire_timed(userdata=None):
+    """Lift whatever timed bans and mutes are due, a channel at a time"""
+    global expiry_timer
+    expiry_timer = None
+    lift_expired(expiries.pop_due(time.time() + expiry_slack))
+    arm_expiry()
+    return False
+
+def lift_expired(keys):
+    """Lift expired entries in the channels we're in. The others keep them
+    until we join."""
+    channels = collections.defaultdict(list)
+    for key in keys:
+        channels[key[:2]].append(key)
+    open_channels = dict([((network_of(c.context), connection(c.id).key(c.channel)), c)
+                          for c in xchat.get_list('channels') if c.type == 2])
+    for channel, keys in channels.items():
+        if channel in open_channels:
+            c = open_channels[channel]
+            lift_in(connection(c.id), c.context, c.channel, keys)
+
+def lift_in(net, context, channel, keys):
+    """Unban and unmute in a single action, so it's one op and packed mode lines.
+    Entries stay until the server says the mode is gone (see do_mode), and
+    are tried again after expiry_retry seconds if it doesn't. The server
+    says nothing when the mask isn't set, so a second try first fetches the
+    ban lists, and drops what isn't on them."""
+    if not keys:
+        return
+    for key in keys:
+        expiries.remember(key, time.time() + expiry_retry)
+    action = Action(net, channel, context.get_info('nick'), context)
+    if net.key(channel) in net.bans_fetched:
+        # Nothing to lift if someone else did already
+        lists = {'b': net.bans[net.key(channel)], 'q': net.quiets[net.key(channel)]}
+        gone = [key for key in keys if key[2] in lists and key[3] not in lists[key[2]]]
+        expiries.remove(gone)
+        keys = [key for key in keys if key not in gone]
+    elif [key for key in keys if key in expiries.tried]:
+        action.needs_op = False
+        action.relift = keys
+        keys = []
+    for key in keys:
+        network, chan, mode, mask = key
+        if mode in ('b', 'q'):
+            action.actions.append('mode %s -%s %s' % (channel, mode, mask.replace('%', '%%')))
+        expiries.tried.add(key)
+    if action.actions or action.relift:
+        action.schedule()
+    arm_expiry()
+
+default_modes_per_line = 3
+def parse_modes(net, modes, args):
+    """Split a mode string into (sign, mode, argument) tuples, by what the
+    server of a connection says takes an argument"""
+    list_modes, param_modes, set_param_modes = net.list_modes, net.param_modes, net.set_param_modes
+    changes = []
+    sign = '+'
+    args = list(args)
+    for mode in modes:
+        if mode in '+-':
+            sign = mode
+            continue
+        arg = None
+        if mode in list_modes or mode in param_modes or (sign == '+' and mode in set_param_modes):
+            if args:
+                arg = args.pop(0)
+        changes.append((sign, mode, arg))
+    return changes
+
+def parse_flags(text):
+    """Split -nihra and -t<seconds> flags off the front of a command line, in
+    one pass. Returns ban types, timer and the rest of the line as typed."""
+    ban_types, timer, pos, end = '', 0, 0, len(text)
+    while pos < end and text[pos] == '-':
+        stop = text.find(' ', pos)
+        if stop == -1:
+            stop = end
+        if text[pos+1:pos+2] == 't':
+            try:
+                timer = int(text[pos+2:stop])
+            except ValueError:
+                pass
+        else:
+            ban_types = text[pos+1:stop]
+        pos = stop
+        while pos < end and text[pos] == ' ':
+            pos += 1
+    return ban_types, timer, text[pos:]
+
+def split_targets(net, spec, text, members):
+    """Split kick/ban arguments into targets, a forward channel, a reason
+    and the words that are none of these
+
+    The first word holds one target or several separated by commas. Words
+    after it are targets too if that is clear: masks, channel members, or
+    lists with commas in them. For kicks they also need a reason after a
+    colon, otherwise the first word is the only target and the rest is the
+    reason. For everything else, words that aren't clearly targets are
+    returned as stray, so the command can be refused."""
+    head, reason = text, ''
+    if ' :' in text:
+        head, reason = text.split(' :', 1)
+    words = head.split()
+    targets, more = [], []
+    if words and not valid_channel(words[0]):
+        targets = [target for target in words.pop(0).split(',') if target]
+    while words and not valid_channel(words[0]):
+        more.append(words.pop(0))
+    def clear(word):
+        parts = [part for part in word.split(',') if part]
+        return parts and not [part for part in parts if not valid_mask(part) and net.key(part) not in members
+                                                           and not (',' in word and valid_nickname(part))]
+    stray = []
+    if 'kick' in spec:
+        if reason and not [word for word in more if not clear(word)]:
+            targets += [target for word in more for target in word.split(',') if target]
+        else:
+            words = more + words
+    else:
+        for word in more:
+            if clear(word):
+                targets += [target for target in word.split(',') if target]
+            else:
+                stray.append(word)
+    forward_to = ''
+    if 'forward' in spec and words:
+        forward_to = words.pop(0)
+    if words:
+        reason = ' '.join(words) + (reason and ' :' + reason)
+    return targets, forward_to, reason, stray
+
+def member_subject(net, nick, member):
+    """What masks are matched against for a channel member, from the user
+    cache if it knows them and from the member list otherwise. Kept on the
+    member until any of it changes."""
+    user = net.users.get(nick)
+    if user:
+        target = (member.nick, user.ident, user.host, user.name, user.account)
+    else:
+        ident, host = ((member.host or '') + '@').split('@')[:2]
+        target = (member.nick, ident, host, None, None)
+    if target != member.target:
+        member.target, member.subject = target, subject(net, *target)
+    return member.subject
+
+def match_members(net, mask, members):
+    """Nicks of the channel members that match a mask"""
+    matcher = net.ban_matchers.get(mask)
+    return [member.nick for nick, member in members.items() if matcher.match(member_subject(net, nick, member))]
+
+def members_hit(net, banlist, members):
+    """The nicks of the channel members that each mask of a ban list hits.
+    Members only try the masks the index of the list picks for them, and
+    masks the index can't file only try the members whose nick!ident@host
+    contains their longest literal part, so many masks against thousands of
+    members stays cheap."""
+    hit = {}
+    for step in hit_steps(net, banlist, members, hit):
+        pass
+    return hit
+
+def hit_steps(net, banlist, members, hit):
+    """members_hit, filling hit and yielding after every member and every
+    mask the index can't file. The list and members may change in between,
+    so this goes through them as they were at the start."""
+    matchers = net.ban_matchers
+    hit.update([(ban, []) for ban in banlist])
+    wildcards = list(banlist.wildcards())
+    subjects = []
+    for nick, member in list(members.items()):
+        data = member_subject(net, nick, member)
+        subjects.append((member.nick, data))
+        for ban in banlist.candidates_for(data, wildcards=False):
+            if matchers.get(ban).match(data):
+                hit.setdefault(ban, []).append(member.nick)
+        yield
+    if wildcards:
+        text = MaskText(subjects, [data[0] for nick, data in subjects])
+        for ban in wildcards:
+            matcher = matchers.get(ban)
+            hit[ban] = [nick for nick, data in text.containing(longest_literal(net.lower(ban_kind(ban)[1])))
+                        if matcher.match(data)]
+            yield
+
+hits_shown = 10 # Nicks shown for every mask by /cs hits and /cs preview
+
+def show_hits(net, members, banlists, everything=True, hits=None):
+    """Show whom the masks of some ban lists hit, and whom we know too
+    little about to tell. banlists are (label, BanList) pairs, the label is
+    shown after every mask of that list. hits are what members_hit says for
+    each list, if that's known already."""
+    shown = 0
+    for index, (label, banlist) in enumerate(banlists):
+        hit = hits and hits[index] or members_hit(net, banlist, members)
+        for ban in banlist:
+            nicks = sorted(hit[ban], key=net.key)
+            if not nicks and not everything:
+                continue
+            shown += 1
+            more = len(nicks) > hits_shown and ' and %d more' % (len(nicks) - hits_shown) or ''
+            xchat.emit_print('Server Text', "%s%s hits %d of %d members%s%s" %
+                    (ban, label, len(nicks), len(members), nicks and ': ' or '', ', '.join(nicks[:hits_shown]) + more))
+    if not shown:
+        xchat.emit_print('Server Text', "Nobody is hit")
+    unknown = len([nick for nick, member in members.items() if not member.host and nick not in net.users])
+    if unknown:
+        xchat.emit_print('Server Text', "%d members are only known by nick, /cs prefetch looks them up" % unknown)
+    if [ban for label, banlist in banlists for ban in banlist if ban_kind(ban)[0] in ('$a', '$r')]:
+        unknown = len([nick for nick in members if not net.users.get(nick) or not net.users.get(nick).knows('ar')])
+        if unknown:
+            xchat.emit_print('Server Text', "Account and realname of %d members are unknown, /cs prefetch looks them up" % unknown)
+
+def preview(net, context, channel, commands):
+    """Show what would be sent instead of sending it, and whom the bans
+    and mutes in there would hit"""
+    if not commands:
+        xchat.emit_print('Server Text', "Nothing would be sent")
+    masks = BanList(net.lower)
+    for command in commands:
+        xchat.emit_print('Server Text', "Would send: %s" % command)
+        mode = _single_mode.match(command)
+        if mode and mode.group(2) in ('+b', '+q'):
+            masks.append(mode.group(3))
+        elif command.startswith('chanserv akick') and ' ADD ' in command:
+            masks.append(command.split()[4])
+    if len(masks):
+        show_hits(net, channel_members(net, context, channel), [('', masks)])
+
+def send_commands(net, context, channel, commands):
+    """Send commands, packing single mode changes for a channel together at the end"""
+    modes = []
+    for command in commands:
+        mode = _single_mode.match(command)
+        if mode and mode.group(1) == channel:
+            modes.append(mode.groups()[1:])
+        else:
+            send(net, context, command)
+    send_modes(net, context, channel, modes)
+
+_single_mode = re.compile(r'^mode (\S+) ([+-][a-zA-Z]) (\S+)$', re.I)
+def send_modes(net, context, channel, changes):
+    """Send (change, argument) mode changes, as many per line as the server allows"""
+    try:
+        per_line = int(net.isupport.get('MODES', default_modes_per_line))
+    except ValueError:
+        per_line = default_modes_per_line
+    while changes:
+        # Stay well clear of the 512 byte line limit
+        count, length = 1, len(channel) + len(changes[0][1])
+        while count < min(per_line, len(changes)) and length + len(changes[count][1]) < 400:
+            length += len(changes[count][1]) + 1
+            count += 1
+        chunk, changes = changes[:count], changes[count:]
+        modes, sign = '', ''
+        for change, arg in chunk:
+            if change[0] != sign:
+                sign = change[0]
+                modes += sign
+            modes += change[1]
+        send(net, context, 'mode %s %s %s' % (channel, modes, ' '.join([arg for change, arg in chunk])))
+
 # Data processing
 def do_mode(word, word_eol, userdata):
-    """Run pending actions when chanserv opped us"""
+    """Run pending actions when we get opped and keep prefixes and ban lists current"""
+    net = connection()
+    channel = net.key(word[2])
+    if channel not in net.managed or len(word) < 5 or word[2][0] not in net.isupport.get('CHANTYPES', '#&'):
+        return
     ctx = xchat.get_context()
-    if 'chanserv!' in word[0].lower() and '+o' in word[3] and ctx.get_info('nick') in word:
-        run_pending(just_opped = ctx.get_info('channel'))
+    args = word[4:]
+    args[-1] = args[-1].lstrip(':')
+    changes = parse_modes(net, word[3].lstrip(':'), args)
+    members = net.roster.get(channel, {})
+    me = net.key(ctx.get_info('nick'))
+    opped = False
+    for sign, mode, arg in changes:
+        if mode in net.prefix_modes and arg is not None:
+            if net.key(arg) in members:
+                set_prefix(net, members[net.key(arg)], sign, mode)
+            opped = opped or (net.key(arg) == me and sign == '+' and mode == 'o')
+    if opped:
+        run_pending(net, ('op', channel))
+    if expiries:
+        network = network_of(ctx)
+        expiries.remove([(network, channel, mode, arg) for sign, mode, arg in changes if sign == '-' and mode in 'bq'])
+    if channel not in net.bans_fetched and channel not in net.collecting_bans:
+        return
+    for sign, mode, arg in changes:
+        if arg is None or mode not in 'bq':
+            continue
+        banlist = (net.bans if mode == 'b' else net.quiets)[channel]
+        if sign == '+':
+            banlist.append(arg, word[0].lstrip(':'), time.time())
+        else:
+            banlist.remove(arg)
 xchat.hook_server('MODE', do_mode)
 
+def do_isupport(word, word_eol, userdata):
+    """Remember what the server supports"""
+    net = connection()
+    isupport = net.isupport
+    for token in word[3:]:
+        if token.startswith(':'):
+            break
+        key, value = (token.split('=', 1) + [''])[:2]
+        isupport[key] = value
+        if key == 'CASEMAPPING':
+            net.set_casemapping(value)
+    if isupport.get('CHANMODES', '').count(',') >= 2:
+        net.list_modes, net.param_modes, net.set_param_modes = isupport['CHANMODES'].split(',')[:3]
+        if isupport.get('PREFIX', '').startswith('('):
+            net.prefix_modes, net.prefix_chars = isupport['PREFIX'][1:].split(')', 1)
+            net.param_modes += net.prefix_modes
+xchat.hook_server('005', do_isupport)
+
 class User(object):
-    def __init__(self, nick, ident, host, name):
+    def __init__(self, nick, ident, host, name=None):
         self.nick = nick; self.ident = ident; self.host = host; self.name = name
         self.account = None
+        self.account_known = False
         self.time = time.time()
+        self.ttl = user_ttl
+
+    def knows(self, fields):
+        """Do we know the account (a) and/or realname (r) of this user"""
+        return ('a' not in fields or self.account_known) and ('r' not in fields or self.name is not None)
+
+class UserCache(object):
+    """Users we know about, forgotten after user_ttl seconds without news
+    and least recently used first when there are more than max_users. key
+    is the casemapping of the connection the users are on."""
+    def __init__(self, key):
+        self.key = key
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, nick):
+        return self.get(nick) is not None
+
+    def __getitem__(self, nick):
+        user = self.get(nick)
+        if user is None:
+            raise KeyError(nick)
+        return user
+
+    def __setitem__(self, nick, user):
+        self.entries.pop(nick, None)
+        self.entries[nick] = user
+        while len(self.entries) > max_users:
+            self.entries.popitem(last=False)
+
+    def __delitem__(self, nick):
+        del self.entries[nick]
+
+    def forget(self, nick):
+        self.entries.pop(nick, None)
+
+    def get(self, nick, default=None):
+        user = self.entries.pop(nick, None)
+        if user is None or user.time < time.time() - user.ttl:
+            return default
+        self.entries[nick] = user
+        return user
+
+    def seen(self, nick, ident, host):
+        """Get or create the entry for a nick!ident@host we just saw"""
+        key = self.key(nick)
+        user = self.get(key)
+        if user is None or user.ident != ident or user.host != host:
+            user = User(key, ident, host)
+        user.time = time.time()
+        user.ttl = max(user.ttl, user_ttl)
+        self[key] = user
+        return user
+
+# Netsplit quits name the two servers that split, like "*.net *.split"
+_netsplit = re.compile(r'^:?[\w*-]+(\.[\w*-]+)+ [\w*-]+(\.[\w*-]+)+$')
+
+def split_prefix(prefix):
+    """Turn :nick!ident@host into its parts"""
+    prefix = prefix.lstrip(':')
+    if '!' not in prefix or '@' not in prefix:
+        return None
+    nick, rest = prefix.split('!', 1)
+    return [nick] + rest.split('@', 1)
+
+class Member(object):
+    """Someone in a channel, like the entries of get_list('users'): host is
+    ident@host if we know it, prefix all their prefixes (@+), highest first"""
+    def __init__(self, nick, host=None, prefix=''):
+        self.nick = nick; self.host = host; self.prefix = prefix
+        # What masks are matched against, and what it was made from
+        self.target = self.subject = None
+no_member = Member(None)
+
+def channel_members(net, context, channel):
+    """The members of a channel by key of their nick. Until we have seen
+    the names of a channel, they come from xchat. They are tracked from then
+    on if we manage the channel, the hooks leave the others alone."""
+    key = net.key(channel)
+    if key in net.roster:
+        return net.roster[key]
+    members = dict([(net.key(user.nick), Member(user.nick, user.host, user.prefix))
+                    for user in context.get_list('users')])
+    if key in net.managed:
+        net.roster[key] = members
+    return members
+
+def set_prefix(net, member, sign, mode):
+    """Give or take a prefix, keeping them in the order the server ranks them"""
+    prefix_chars = net.prefix_chars
+    char = prefix_chars[net.prefix_modes.index(mode)]
+    prefixes = member.prefix.replace(char, '') + (sign == '+' and char or '')
+    member.prefix = ''.join([c for c in prefix_chars if c in prefixes])
+
+def do_names(word, word_eol, userdata):
+    """Collect a names reply, entries look like @+nick or @nick!ident@host"""
+    # :server 353 me = #channel :@nick +nick nick
+    net = connection()
+    if net.key(word[4]) not in net.managed:
+        return
+    prefix_chars = net.prefix_chars
+    members = net.names_pending.setdefault(net.key(word[4]), {})
+    for entry in word_eol[5].lstrip(':').split():
+        nick = entry.lstrip(prefix_chars)
+        prefix = entry[:len(entry) - len(nick)]
+        host = None
+        if '!' in nick:
+            nick, host = nick.split('!', 1)
+        members[net.key(nick)] = Member(nick, host, ''.join([c for c in prefix_chars if c in prefix]))
+xchat.hook_server('353', do_names)
+
+def do_endnames(word, word_eol, userdata):
+    """A channel's names are complete, they replace whatever we had"""
+    net = connection()
+    key = net.key(word[3])
+    if key in net.managed:
+        net.roster[key] = net.names_pending.pop(key, {})
+xchat.hook_server('366', do_endnames)
+
+def do_quit(word, word_eol, userdata):
+    """Whoever quits leaves all channels"""
+    prefix = split_prefix(word[0])
+    if prefix:
+        net = connection()
+        nick = net.key(prefix[0])
+        for members in net.roster.values():
+            members.pop(nick, None)
+        # Whoever takes the nick next is someone else
+        net.users.forget(nick)
+        if net.flood_guards and _netsplit.match(word_eol[2]):
+            if len(net.split) >= max_users:
+                net.split.clear()
+            net.split[net.lower(word[0])] = time.time()
+xchat.hook_server('QUIT', do_quit)
+
+def do_kill(word, word_eol, userdata):
+    """Whoever is killed leaves all channels too"""
+    net = connection()
+    nick = net.key(word[2])
+    for members in net.roster.values():
+        members.pop(nick, None)
+    net.users.forget(nick)
+xchat.hook_server('KILL', do_kill)
+
 def do_whois(word, word_eol, userdata):
-    """Store whois replies in global cache"""
-    nick = word[3].lower()
+    """Store whois replies in the cache of the connection"""
+    net = connection()
+    users = net.users
+    nick = net.key(word[3])
     if word[1] == '330':
-        users[nick].account = word[4]
+        if nick in users:
+            users[nick].account = word[4]
     else:
         users[nick] = User(nick, word[4], word[5], word_eol[7][1:])
+        users[nick].account_known = True
+        if not [members for members in net.roster.values() if nick in members]:
+            users[nick].ttl = whois_ttl
 xchat.hook_server('311', do_whois)
 xchat.hook_server('330', do_whois)
 xchat.hook_server('314', do_whois) # This actually is a /whowas reply
 
+def do_join(word, word_eol, userdata):
+    """Remember who joins, with account and realname if extended-join is on"""
+    prefix = split_prefix(word[0])
+    if not prefix:
+        return
+    net = connection()
+    channel = word[2].lstrip(':')
+    if net.key(prefix[0]) == net.key(xchat.get_info('nick')):
+        context = xchat.get_context()
+        manage_channel(net, context, channel)
+        if net.key(channel) in net.managed:
+            # Names are on their way
+            net.roster[net.key(channel)] = {}
+        if prefetch:
+            fetch_members(net, context, channel)
+        # Lift whatever expired while we were away
+        lift_in(net, context, channel, expiries.overdue(network_of(context), net.key(channel), time.time()))
+        return
+    if net.key(channel) not in net.managed:
+        return
+    if net.key(channel) in net.roster:
+        net.roster[net.key(channel)][net.key(prefix[0])] = Member(prefix[0], '%s@%s' % tuple(prefix[1:]))
+    user = net.users.seen(*prefix)
+    if len(word) > 4:
+        user.account = word[3] != '*' and word[3] or None
+        user.account_known = True
+        user.name = word_eol[4][1:]
+    guard = net.flood_guards and flood_target(net, channel, prefix[0])
+    # Coming back from a netsplit is no flood
+    if guard and net.split.get(net.lower(word[0]), 0) < time.time() - flood_split_rejoin:
+        react(net, guard, guard.join(time.time(), prefix[2]))
+xchat.hook_server('JOIN', do_join)
+
+def do_who(word, word_eol, userdata):
+    """Remember users from /who replies"""
+    # :server 352 me #channel ident host server nick flags :hops realname
+    net = connection()
+    if net.key(word[3]) not in net.managed:
+        return
+    user = net.users.seen(word[7], word[4], word[5])
+    if len(word) > 10:
+        user.name = word_eol[10]
+    member = net.roster.get(net.key(word[3]), {}).get(user.nick)
+    if member:
+        member.host = '%s@%s' % (word[4], word[5])
+xchat.hook_server('352', do_who)
+
+whox_token = '731'
+def fetch_members(net, context, channel):
+    """Learn everything about all members of a channel with one /who"""
+    if 'WHOX' not in net.isupport or net.key(channel) in [c for c, nicks in net.whox_pending]:
+        return
+    net.whox_pending.append((net.key(channel), []))
+    send(net, context, 'who %s %%tnuhar,%s' % (channel, whox_token), BULK)
+
+def do_whox(word, word_eol, userdata):
+    """Remember users from our own /who %tnuhar replies"""
+    # :server 354 me token ident host nick account :realname
+    # No channel in there, but replies come in the order we asked
+    net = connection()
+    if word[3] != whox_token or len(word) < 9 or not net.whox_pending:
+        return
+    user = net.users.seen(word[6], word[4], word[5])
+    user.account = word[7] != '0' and word[7] or None
+    user.account_known = True
+    user.name = word_eol[8][1:]
+    # Joins, parts and nick/host/account changes keep this up to date
+    user.ttl = member_ttl
+    net.whox_pending[0][1].append(user.nick)
+    return xchat.EAT_ALL
+xchat.hook_server('354', do_whox)
+
+def do_endwho(word, word_eol, userdata):
+    """Finish a channel's /who %tnuhar"""
+    net = connection()
+    whox_pending = net.whox_pending
+    # Xchat does its own /who on join, so don't end ours before it started
+    if whox_pending and whox_pending[0][1] and whox_pending[0][0] == net.key(word[3]):
+        channel, nicks = whox_pending.pop(0)
+        net.members_fetched[channel] = (time.time(), nicks)
+        for nick in nicks:
+            run_pending(net, ('whois', nick))
+        return xchat.EAT_ALL
+xchat.hook_server('315', do_endwho)
+
+def do_account(word, word_eol, userdata):
+    """Follow account changes (account-notify)"""
+    prefix = split_prefix(word[0])
+    if prefix:
+        user = connection().users.seen(*prefix)
+        user.account = word[2].lstrip(':') != '*' and word[2].lstrip(':') or None
+        user.account_known = True
+xchat.hook_server('ACCOUNT', do_account)
+
+def do_chghost(word, word_eol, userdata):
+    """Follow ident/host changes (chghost)"""
+    prefix = split_prefix(word[0])
+    net = connection()
+    user = prefix and net.users.get(net.key(prefix[0]))
+    if user:
+        user.ident, user.host = word[2], word[3].lstrip(':')
+        user.time = time.time()
+xchat.hook_server('CHGHOST', do_chghost)
+
+def do_nick(word, word_eol, userdata):
+    """Follow nick changes"""
+    prefix = split_prefix(word[0])
+    net = connection()
+    if prefix:
+        old, new = net.key(prefix[0]), word[2].lstrip(':')
+        for channel, members in list(net.roster.items()):
+            if old in members:
+                member = members[net.key(new)] = members.pop(old)
+                member.nick = new
+                guard = net.flood_guards and flood_target(net, channel, new)
+                if guard:
+                    react(net, guard, guard.nick(time.time(), prefix[2]))
+    users = net.users
+    user = prefix and users.get(net.key(prefix[0]))
+    if user:
+        del users[user.nick]
+        user.nick = net.key(word[2].lstrip(':'))
+        user.time = time.time()
+        users[user.nick] = user
+xchat.hook_server('NICK', do_nick)
+
 def do_missing(word, word_eol, userdata):
     """Fall back to whowas if whois fails"""
-    for p in pending:
-        if p.target == word[3]:
-            p.context.command('whowas %s' % word[3])
+    net = connection()
+    for p in net.waiting.get(('whois', net.key(word[3])), []):
+        if not p.finished:
+            send(net, p.context, 'whowas %s' % word[3])
             break
 xchat.hook_server('401', do_missing)
 
 def do_endwas(word, word_eol, userdata):
     """Display error if nickname cannot be resolved"""
-    for p in pending:
-        if p.target == word[3]:
-            xchat.emit_print("Server Error", "%s could not be found" % p.target)
-            pending.remove(p)
+    net = connection()
+    for p in net.waiting.pop(('whois', net.key(word[3])), []):
+        if not p.finished:
+            p.context.emit_print("Server Error", "%s could not be found" % p.target)
+            p.cancel()
 xchat.hook_server('406', do_endwas)
 
 def endofwhois(word, word_eol, userdata):
     """Process the queue after nickname resolution"""
-    run_pending()
+    net = connection()
+    run_pending(net, ('whois', net.key(word[3])))
 xchat.hook_server('318', endofwhois)
 xchat.hook_server('369', endofwhois)
 
 xchat.hook_server('482', lambda word, word_eol, userdata: xchat.emit_print('Server Error', '%s in %s' % (word_eol[4][1:], word[3])))
 
+def set_by(word, index):
+    """Who set a ban list entry and when, if the server tells"""
+    try:
+        return word[index], float(word[index + 1])
+    except (IndexError, ValueError):
+        return None, None
+
 def do_ban(word, word_eol, userdata):
     """Process banlists"""
-    channel, ban = word[3:5]
-    if channel in collecting_bans:
-        bans[channel].append(ban)
+    # :server 367 me #channel mask setter time
+    net = connection()
+    channel, ban = net.key(word[3]), word[4]
+    if channel in net.collecting_bans:
+        net.bans[channel].append(ban, *set_by(word, 5))
         return xchat.EAT_ALL
     return xchat.EAT_NONE
 xchat.hook_server('367', do_ban)
 
 def do_quiet(word, word_eol, userdata):
     """Process banlists"""
-    channel, ban = word[3], word[5]
-    if channel in collecting_bans:
-        quiets[channel].append(ban)
+    # :server 728 me #channel q mask setter time
+    net = connection()
+    channel, ban = net.key(word[3]), word[5]
+    if channel in net.collecting_bans:
+        net.quiets[channel].append(ban, *set_by(word, 6))
         return xchat.EAT_ALL
     return xchat.EAT_NONE
 xchat.hook_server('728', do_quiet)
 
 def do_endban(word, word_eol, userdata):
     """Process end-of-ban markers"""
-    channel = word[3]
-    if channel in collecting_bans:
+    net = connection()
+    if net.key(word[3]) in net.collecting_bans:
         return xchat.EAT_ALL
     return xchat.EAT_NONE
 xchat.hook_server('368', do_endban)
 
 def do_endquiet(word, word_eol, userdata):
     """Process end-of-quiet markers"""
-    channel = word[3]
-    if channel in collecting_bans:
-        xchat.command('quote cs akick %s list' % channel)
+    net = connection()
+    if net.key(word[3]) in net.collecting_bans:
+        net.akick_lists.request(xchat.get_context(), word[3])
         return xchat.EAT_ALL
     return xchat.EAT_NONE
 xchat.hook_server('729', do_endquiet)
@@ -559,75 +2615,303 @@ xchat.command('SET -quiet irc_auto_rejoin ON')
 
 def rejoin(word, word_eol, userdata):
     """Rejoin when /remove'd"""
-    if word[0][1:word[0].find('!')] == xchat.get_info('nick') and len(word) > 3 and word[3][1:].lower() == 'requested':
-        xchat.command('join %s' % word[2])
+    net = connection()
+    requested = len(word) > 3 and word[3][1:].lower() == 'requested'
+    if net.key(word[2]) not in net.managed and not requested:
+        return
+    nick = net.key(word[0][1:word[0].find('!')])
+    net.roster.get(net.key(word[2]), {}).pop(nick, None)
+    if nick == net.key(xchat.get_info('nick')):
+        # We won't see mode changes while we're out
+        forget_channel(net, net.key(word[2]))
+        if requested:
+            send(net, xchat.get_context(), 'join %s' % word[2])
 xchat.hook_server('PART', rejoin)
 
+def on_kick(word, word_eol, userdata):
+    """Forget about channels we've been kicked from"""
+    net = connection()
+    net.roster.get(net.key(word[2]), {}).pop(net.key(word[3]), None)
+    if net.key(word[3]) == net.key(xchat.get_info('nick')):
+        forget_channel(net, net.key(word[2]))
+xchat.hook_server('KICK', on_kick)
+
+def on_disconnect(word, word_eol, userdata):
+    """Forget everything about a connection when it is gone, a reconnect
+    starts from scratch"""
+    net = connections.pop(xchat.get_prefs('id'), None)
+    if net:
+        net.close()
+xchat.hook_print('Disconnected', on_disconnect)
+
+def ask_chanserv(command):
+    """A hook that asks chanserv for something for the channel of a numeric,
+    on the connection the numeric came from"""
+    return lambda word, word_eol, userdata: send(connection(), xchat.get_context(), 'quote cs %s %s' % (command, word[3]))
+
 # Unban when muted
-xchat.hook_server('404', lambda word, word_eol, userdata: xchat.command('quote cs unban %s' % word[3]))
+xchat.hook_server('404', ask_chanserv('unban'))
 
 # Convince chanserv to let me in when key/unban/invite is needed
-xchat.hook_server('471', lambda word, word_eol, userdata: xchat.command('quote cs invite %s' % word[3])) # 471 = limit reached
-xchat.hook_server('473', lambda word, word_eol, userdata: xchat.command('quote cs invite %s' % word[3]))
-xchat.hook_server('474', lambda word, word_eol, userdata: xchat.command('quote cs unban %s' % word[3]))
-xchat.hook_server('475', lambda word, word_eol, userdata: xchat.command('quote cs getkey %s' % word[3]))
+xchat.hook_server('471', ask_chanserv('invite')) # 471 = limit reached
+xchat.hook_server('473', ask_chanserv('invite'))
+xchat.hook_server('474', ask_chanserv('unban'))
+xchat.hook_server('475', ask_chanserv('getkey'))
 
 def on_invite(word, word_eol, userdata):
     """Autojoin when chanserv invites us"""
     if word[0] == ':ChanServ!ChanServ@services.':
-        xchat.command('join %s' % word[-1][1:])
+        send(connection(), xchat.get_context(), 'join %s' % word[-1][1:])
 xchat.hook_server('INVITE', on_invite)
 
+# Flood protection
+class SlidingWindow(object):
+    """The events of the last window seconds, each with a key and an item,
+    never more than size of them. Adding an event tells how often its key
+    was seen in the window, without looking at the other events."""
+    def __init__(self, window, size=flood_memory):
+        self.window = window
+        self.size = size
+        self.events = collections.deque()
+        self.counts = {}
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, now, key, item):
+        events = self.events
+        while events and (events[0][0] <= now - self.window or len(events) >= self.size):
+            self.drop()
+        events.append((now, key, item))
+        count = self.counts[key] = self.counts.get(key, 0) + 1
+        return count
+
+    def drop(self):
+        stamp, key, item = self.events.popleft()
+        self.counts[key] -= 1
+        if not self.counts[key]:
+            del self.counts[key]
+
+    def take(self, key=None):
+        """Remove and return the items of a key, or all of them"""
+        taken = [item for stamp, k, item in self.events if key is None or k == key]
+        if key is None:
+            self.events.clear()
+            self.counts.clear()
+        elif key in self.counts:
+            self.events = collections.deque([event for event in self.events if event[1] != key])
+            del self.counts[key]
+        return taken
+
+class FloodGuard(object):
+    """Watches a channel for join floods, clones joining from one host,
+    repeated lines and nick changes, and answers them with a /cs command:
+    mutes or kickbans of the hosts involved, lifted after flood_ban_time.
+    Memory use is fixed: every kind of flood remembers at most flood_memory
+    events."""
+    kinds = ('joins', 'clones', 'repeats', 'nicks')
+
+    def __init__(self, context, channel):
+        self.context = context
+        self.channel = channel
+        self.joins = SlidingWindow(flood_joins[1])
+        self.clones = SlidingWindow(flood_clones[1])
+        self.repeats = SlidingWindow(flood_repeats[1])
+        self.nicks = SlidingWindow(flood_nicks[1])
+        self.stopped = dict([(kind, 0) for kind in self.kinds])
+
+    def join(self, now, host):
+        if self.clones.add(now, host, host) >= flood_clones[0]:
+            self.clones.take(host)
+            self.joins.take(host)
+            return self.answer('clones', 'kickban', [host], ' :Clone flood')
+        self.joins.add(now, host, host)
+        if len(self.joins) > flood_joins[0]:
+            self.clones.take()
+            return self.answer('joins', 'mute', self.joins.take())
+
+    def message(self, now, host, text):
+        # Only the same host saying the same thing, many people say "lol"
+        line = (host, text.lower())
+        if self.repeats.add(now, line, host) >= flood_repeats[0]:
+            return self.answer('repeats', 'mute', self.repeats.take(line))
+
+    def nick(self, now, host):
+        if self.nicks.add(now, host, host) >= flood_nicks[0]:
+            return self.answer('nicks', 'mute', self.nicks.take(host))
+
+    def answer(self, kind, command, hosts, reason=''):
+        self.stopped[kind] += 1
+        stats.count('flood ' + kind)
+        masks = []
+        for host in hosts:
+            if '*!*@' + host not in masks:
+                masks.append('*!*@' + host)
+        return '%s -t%d %s%s' % (command, flood_ban_time, ' '.join(masks), reason)
+
+    def lines(self):
+        yield "Flood protection in %s is on, floods stopped:" % self.channel
+        for kind, (limit, window) in zip(self.kinds, (flood_joins, flood_clones, flood_repeats, flood_nicks)):
+            yield "  %-7s (%d in %ds): %d" % (kind, limit, window, self.stopped[kind])
+
+def react(net, guard, command):
+    """Do what a FloodGuard decided, like /cs would"""
+    if not command:
+        return
+    name, text = command.split(' ', 1)
+    context = guard.context
+    want_access(net, context)
+    action = Action(net, guard.channel, context.get_info('nick'), context)
+    cs_targets(commands[name], action, text)
+
+def flood_target(net, channel, nick):
+    """The FloodGuard of a channel if it watches a nick, that is: if we
+    watch the channel at all and the nick isn't us or opped or voiced"""
+    guard = net.flood_guards.get(net.key(channel))
+    if guard is None:
+        return None
+    member = channel_members(net, guard.context, channel).get(net.key(nick))
+    if (member and member.prefix) or net.key(nick) == net.key(guard.context.get_info('nick')):
+        return None
+    return guard
+
+def do_privmsg(word, word_eol, userdata):
+    """Look for repeated lines in the channels we watch"""
+    net = connection()
+    if not net.flood_guards or len(word) < 4:
+        return
+    prefix = split_prefix(word[0])
+    guard = prefix and flood_target(net, word[2], prefix[0])
+    if guard:
+        react(net, guard, guard.message(time.time(), prefix[2], word_eol[3][1:]))
+xchat.hook_server('PRIVMSG', do_privmsg)
+
+# Channels to watch for floods from the start, one per line, optionally
+# after the name of the network: "#channel" or "freenode #channel"
+flood_channels = []
+try:
+    for line in open(os.path.join(xchat.get_info('xchatdir'), 'chanserv.py-flood')):
+        words = line.split()
+        if 1 <= len(words) <= 2:
+            flood_channels.append(([None] + words)[-2:])
+except (IOError, OSError):
+    pass
+
+def manage_channel(net, context, channel):
+    """Start watching a channel we're in for floods, if it is one we want
+    watched, and for its timed bans being lifted by others"""
+    network = network_of(context)
+    for name, chan in flood_channels:
+        if name in (None, network) and net.key(chan) == net.key(channel):
+            net.flood_guards.setdefault(net.key(channel), FloodGuard(context, channel))
+            net.managed.add(net.key(channel))
+    if expiries.has(network, net.key(channel)):
+        net.managed.add(net.key(channel))
+
+class AkickParser(object):
+    """Reads chanserv's akick lists, for any number of channels
+
+    Chanserv answers in the order we asked, so the lists come one after
+    another, and a refusal is for the oldest list we haven't seen yet.
+    Each list is turned into Akick entries, and when it is complete the
+    channel's ban lists are too. Lists we didn't ask for are left alone."""
+    header = re.compile(r'^AKICK list for (\S+):$')
+    entry = re.compile(r'^\d+: (\S+) ?(.*?) ?\[setter: ([^,\]]*)(?:, expires: ([^,\]]*))?(?:, modified: [^\]]*)?\]$')
+    footer = re.compile(r"^Total of \d+ \w+ in (\S+)'s AKICK list\.$")
+    refused = 'You are not authorized to perform this operation.'
+
+    def __init__(self, net):
+        self.net = net
+        self.requested = collections.deque()
+        self.channel = None
+        self.akicks = None
+
+    def request(self, context, channel):
+        self.requested.append(self.net.key(channel))
+        send(self.net, context, 'quote cs akick %s list' % channel, BULK)
+
+    def feed(self, text):
+        """Process a chanserv notice, True if it was part of a list we asked for"""
+        text = text.replace('\x02', '')
+        if self.channel is None:
+            if text == self.refused and self.requested:
+                # No access, do without akicks
+                self.done(self.requested.popleft(), AkickList(self.net.lower))
+                return True
+            header = self.header.match(text)
+            if not header or self.net.key(header.group(1)) not in self.requested:
+                return False
+            self.channel = self.net.key(header.group(1))
+            self.requested.remove(self.channel)
+            self.akicks = AkickList(self.net.lower)
+            return True
+        entry = self.entry.match(text)
+        if entry:
+            mask, reason, setter, expires = entry.groups()
+            if reason.startswith('(') and reason.endswith(')'):
+                reason = reason[1:-1]
+            self.akicks.add(Akick(mask, reason, setter, expires and time.time() + parse_duration(expires) or None))
+            return True
+        # The footer, or something unexpected. Either way the list is over.
+        self.done(self.channel, self.akicks)
+        return bool(self.footer.match(text))
+
+    def done(self, channel, entries):
+        self.channel = self.akicks = None
+        if channel in self.net.collecting_bans:
+            self.net.akicks[channel] = entries
+            bans_collected(self.net, channel)
+
+def parse_duration(text):
+    """Seconds in a duration like chanserv shows them: 1h 59m 50s"""
+    units = {'w': 604800, 'd': 86400, 'h': 3600, 'm': 60, 's': 1}
+    return sum([int(n) * units[unit] for n, unit in re.findall(r'(\d+)\s*([wdhms])', text)])
+
+def want_access(net, context):
+    """Ask nickserv where we have access, unless we did so recently. The
+    answer comes before that of anything asked after it, like an op request."""
+    if net.access_fetched is not None and net.access_fetched > time.time() - access_ttl:
+        return
+    net.access_fetched = time.time()
+    net.access_pending = set()
+    send(net, context, 'quote ns listchans')
+
 def on_notice(word, word_eol, userdata):
-    global current_akick
     if word[0] == ':NickServ!NickServ@services.':
-        if word[3:5] == [':Access', 'flag(s)'] and 'f' in word[5]:
-            can_do_akick.append(word[-1])
+        net = connection()
+        if word[3:5] == [':Access', 'flag(s)']:
+            channel = net.key(word[-1])
+            net.managed.add(channel)
+            if 'f' in word[5] and net.access_pending is not None:
+                net.access_pending.add(channel)
+            elif 'f' in word[5]:
+                # Someone did /ns listchans by hand
+                net.can_do_akick.add(channel)
+        elif 'channel access' in word_eol[3] and net.access_pending is not None:
+            # The end of the list, it replaces what we had
+            net.can_do_akick, net.access_pending = net.access_pending, None
         return
     if word[0] != ':ChanServ!ChanServ@services.':
         return
+    net = connection()
     if 'Unbanned' in word_eol[0]:
-        xchat.command('JOIN %s' % word[6].strip()[1:-1])
+        send(net, xchat.get_context(), 'JOIN %s' % word[6].strip()[1:-1])
     if 'key is' in word_eol[0]:
-        xchat.command('JOIN %s %s' % (word[4][1:-1], word[-1]))
-
-    # Yay heuristics. Chances are reasonable that only one channel is in
-    # collecting_bans at any time, so let's assume that. Worst that could
-    # happen is that non-existing bans are shown or removal of them is tried.
-    if word_eol[3] == ':You are not authorized to perform this operation.':
-        # Tried akick list and failed. Just run all bans
-        for channel in collecting_bans[:]:
-            collecting_bans.remove(channel)
-            run_pending()
-        current_akick = None
-        return xchat.EAT_ALL
-
-    if word_eol[3].startswith(':AKICK list'):
-        current_akick = word[-1][1:-2]
-        if current_akick in collecting_bans:
-            return xchat.EAT_ALL
-        else:
-            current_akick = None
-
-    if current_akick and '[setter:' in word_eol[0] and 'modified:' in word_eol[0]:
-        # This looks like a ban to me. So everybody, just follow me.
-        ban = word[4][1:-1]
-        if '!' not in ban:
-            ban = ban + '!*@*'
-        ban += '$# akick ' + word_eol[5]
-        bans[current_akick].append(ban)
-        return xchat.EAT_ALL
+        send(net, xchat.get_context(), 'JOIN %s %s' % (word[4][1:-1], word[-1]))
 
-    if current_akick and word_eol[0].endswith('AKICK list.'):
-        current_akick = None
-        channel = word[-3][1:-3]
-        collecting_bans.remove(channel)
-        run_pending()
+    if net.akick_lists.feed(word_eol[3][1:]):
         return xchat.EAT_ALL
 
 xchat.hook_server('NOTICE', on_notice)
-# Fetch channel access
-xchat.command('quote ns listchans')
-xchat.hook_server('376', lambda w, we, u: xchat.command('quote ns listchans'))
+if record:
+    start_recording(os.path.join(xchat.get_info('xchatdir'), time.strftime('chanserv.py-%Y%m%d-%H%M%S.rec')))
+# Channel access is asked for on the first /cs, the channels we're already
+# in are watched from now on
+for c in xchat.get_list('channels'):
+    if c.type == 2:
+        manage_channel(connection(c.id), c.context, c.channel)
+# Lift timed bans that expired while we weren't running
+lift_expired(expiries.pop_due(time.time()))
+arm_expiry()
 
 xchat.emit_print('Server Text',"Loaded %s %s by Seveas <dennis@kaarsemaker.net>" % (__module_description__, __module_version__))